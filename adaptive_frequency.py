@@ -0,0 +1,117 @@
+import time
+import logging
+from dataclasses import dataclass
+from datetime import datetime
+from statistics import median
+from typing import Callable, List, Optional
+
+from metrics_refresh import MetricsRefresher
+
+logger = logging.getLogger(__name__)
+
+POST = "post"
+SKIP = "skip"
+DELAY = "delay"
+ADVANCE = "advance"
+
+
+@dataclass
+class Decision:
+    action: str
+    reason: str
+    delay_minutes: int = 0
+
+
+def engagement(snapshot: dict) -> float:
+    """Взвешенная активность: репосты ценнее лайков, просмотры дают слабый сигнал"""
+    return snapshot["likes"] + 2 * snapshot["reposts"] + snapshot["comments"] + snapshot["views"] / 100
+
+
+class PostingController:
+    """
+    Адаптивная частота публикаций по живой реакции аудитории.
+    Перед слотом одним дешевым запросом обновляет метрики последнего поста и
+    сравнивает скорость набора активности с медианой прошлых постов в том же возрасте:
+    аудитория не реагирует — слот сдвигается или пропускается,
+    пост «заходит» — следующий слот можно перенести пораньше.
+    """
+    def __init__(
+        self,
+        metrics: MetricsRefresher,
+        owner_id: int,
+        poll_latest: Callable[[], List[dict]],
+        daily_budget: int = 4,
+        min_gap_hours: float = 2,
+        low_ratio: float = 0.5,
+        high_ratio: float = 1.5,
+        delay_minutes: int = 90,
+        history_size: int = 20,
+    ):
+        self.metrics = metrics
+        self.owner_id = owner_id
+        self.poll_latest = poll_latest
+        self.daily_budget = daily_budget
+        self.min_gap_hours = min_gap_hours
+        self.low_ratio = low_ratio
+        self.high_ratio = high_ratio
+        self.delay_minutes = delay_minutes
+        self.history_size = history_size
+
+    def _posts_today(self) -> int:
+        midnight = datetime.combine(datetime.now().date(), datetime.min.time())
+        return len(self.metrics.posts_since(self.owner_id, int(midnight.timestamp())))
+
+    def _engagement_at(self, post: dict, age: float) -> Optional[float]:
+        """Активность поста на снимке, ближайшем к возрасту age (в секундах)"""
+        curve = self.metrics.curve(self.owner_id, post["id"])
+        if not curve:
+            return None
+        nearest = min(curve, key=lambda s: (abs(s["ts"] - post["date"] - age), -s["ts"]))
+        # Снимок сильно позже нужного возраста завышает скорость — такой пост не годится для сравнения
+        if abs(nearest["ts"] - post["date"] - age) > max(age * 0.5, 1800):
+            return None
+        return engagement(nearest)
+
+    def velocity(self) -> Optional[float]:
+        """Отношение скорости последнего поста к медиане прошлых постов в том же возрасте"""
+        try:
+            self.metrics.track(self.poll_latest())
+        except Exception as e:
+            logger.error(f"Не удалось обновить метрики последнего поста: {e}")
+
+        posts = [p for p in self.metrics.posts_since(self.owner_id, 0, limit=self.history_size + 1)
+                 if not p.get("is_pinned")]
+        if len(posts) < 2:
+            return None
+
+        last, history = posts[0], posts[1:]
+        age = time.time() - last["date"]
+        current = self._engagement_at(last, age)
+        past = [e for e in (self._engagement_at(p, age) for p in history) if e is not None]
+        if current is None or len(past) < 3:
+            return None
+        baseline = median(past)
+        return current / baseline if baseline else None
+
+    def last_post_age_hours(self) -> Optional[float]:
+        posts = self.metrics.posts_since(self.owner_id, 0, limit=1)
+        return (time.time() - posts[0]["date"]) / 3600 if posts else None
+
+    def decide(self) -> Decision:
+        """Решение для ближайшего слота"""
+        if self._posts_today() >= self.daily_budget:
+            return Decision(SKIP, f"дневной лимит {self.daily_budget} постов исчерпан")
+
+        ratio = self.velocity()
+        if ratio is None:
+            return Decision(POST, "мало данных для сравнения, публикую по расписанию")
+
+        age = self.last_post_age_hours()
+        if ratio < self.low_ratio:
+            # Прошлый пост аудитория не заметила: сначала сдвигаем, совсем тихо — пропускаем
+            if ratio < self.low_ratio / 2:
+                return Decision(SKIP, f"аудитория насыщена (скорость {ratio:.2f} от обычной)")
+            return Decision(DELAY, f"слабая реакция (скорость {ratio:.2f} от обычной)", self.delay_minutes)
+        if ratio > self.high_ratio and age is not None and age >= self.min_gap_hours:
+            return Decision(ADVANCE, f"высокая вовлеченность (скорость {ratio:.2f} от обычной)")
+        return Decision(POST, f"обычная реакция (скорость {ratio:.2f} от обычной)")
@@ -5,6 +5,11 @@ from datetime import datetime, timedelta
 import google.generativeai as genai
 from dotenv import load_dotenv
 
+from metrics_refresh import MetricsRefresher
+from rate_limit import TokenBucket
+from vk_resolver import GroupResolver
+from weekly_digest import WeeklyDigest
+
 # Load environment variables from .env file
 load_dotenv()
 
@@ -14,12 +19,12 @@ API_VERSION = os.getenv("VK_API_VERSION")
 GROUP_SCREEN_NAME = os.getenv("VK_GROUP_SCREEN_NAME")
 
 GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')  # должен быть установлен в окружении
+GEMINI_RPM = int(os.getenv("GEMINI_RPM", "10"))
 
 # --- Инициализация VK API ---
 api = vk.API(access_token=ACCESS_TOKEN, v=API_VERSION)
-group_info = api.groups.getById(group_id=GROUP_SCREEN_NAME)[0]
-group_id = group_info["id"]
-owner_id = -group_id
+groups = GroupResolver(lambda refs: api.groups.getById(group_ids=",".join(refs), fields="members_count"))
+owner_id = groups.owner_id(GROUP_SCREEN_NAME)
 
 # --- Получаем посты за последнюю неделю ---
 week_ago = int((datetime.now() - timedelta(days=7)).timestamp())
@@ -42,33 +47,18 @@ while True:
 
 print(f"Собрано постов: {len(posts)}")
 
-# --- Формируем текст для Gemini с метриками ---
-posts_summary = []
-for p in posts:
-    text = p["text"].replace("\n", " ").strip()
-    likes = p["likes"]["count"]
-    reposts = p["reposts"]["count"]
-    views = p.get("views", {}).get("count", 0)
-    posts_summary.append(f"Текст: «{text[:100]}...» | Лайки: {likes} | Репосты: {reposts} | Просмотры: {views}")
-
-combined_text = "\n\n".join(posts_summary)
-if len(combined_text) > 3000:  # ограничим размер
-    combined_text = combined_text[:3000] + "\n...[текст обрезан]"
+# --- Сохраняем посты в хранилище, дайджест читает их оттуда пачками ---
+metrics = MetricsRefresher()
+metrics.track(posts)
 
 # --- Инициализация Gemini через genai SDK ---
 genai.configure(api_key=GEMINI_API_KEY)
 
 model = genai.GenerativeModel("gemini-2.0-flash")
 
-# --- Формируем промпт ---
-prompt = (
-    "Ты аналитик, который кратко подводит итоги по группе ВКонтакте с учетом лайков, репостов и просмотров.\n"
-    "Проанализируй и дай саммари по этим постам и их метрикам:\n" + combined_text
-)
-
-# --- Запрос к Gemini ---
-response = model.generate_content(prompt)
-summary = response.text
+# --- Суммаризация всех постов без обрезки: map-reduce под лимитом запросов ---
+digest = WeeklyDigest(model, TokenBucket(rate=GEMINI_RPM / 60, capacity=GEMINI_RPM), metrics)
+summary = digest.build(owner_id, week_ago)
 
 print("\n--- Gemini аналитика ---\n")
-print(summary)
\ No newline at end of file
+print(summary)
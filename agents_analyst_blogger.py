@@ -1,18 +1,33 @@
 import os
 import time
+import asyncio
+import argparse
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from typing import List, Tuple
-from pytz import timezone
 from dotenv import load_dotenv
-from PIL import Image
-from io import BytesIO
 
 
 import vk
-import requests
 import google.generativeai as _genai
-from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+
+from adaptive_frequency import PostingController, ADVANCE, DELAY, SKIP
+from content_calendar import ContentPlanner, MOSCOW_TZ, POSTING_SLOTS
+from delivery_queue import DeliveryQueue, TelegramSender, VKSender
+from draft_pool import DraftPool
+from draft_scorer import DraftScorer
+from dry_run import Fixtures, RecordedImageClient, RecordedModel, RecordedVKAPI, RecordingSender, write_report
+from job_control import Deadline, JobGuard, next_slot
+from log_setup import setup_logging
+from metrics_refresh import MetricsRefresher, fetch_new_posts
+from pipeline import CycleResult, PostingPipeline
+from publish_journal import PublishJournal
+from rate_limit import RateLimitTimeout, TokenBucket
+from vk_resolver import GroupResolver
+from weekly_digest import WeeklyDigest
+from workers import ProcessWorkers
 
 # ======================
 # --- ЗАГРУЗКА ОКРУЖЕНИЯ ---
@@ -27,24 +42,74 @@ VK_GROUP_ID = os.getenv("VK_GROUP_ID")  # Твоя группа ВК
 
 TG_BOT_TOKEN = os.getenv("TG_BOT_TOKEN") 
 TG_CHAT_ID = os.getenv("TG_CHAT_ID")  # Твой Telegram-чат
+# Можно перечислить несколько чатов через запятую
+TG_CHAT_IDS = [chat_id.strip() for chat_id in (TG_CHAT_ID or "").split(",") if chat_id.strip()]
 
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 VK_BLOG_GROUP = os.getenv("VK_BLOG_GROUP")
 
+# Процессы для CPU-тяжелой работы (картинки, скоринг); 0 — все в основном процессе
+WORKER_PROCESSES = int(os.getenv("WORKER_PROCESSES", str(os.cpu_count() or 1)))
+# Сколько циклов публикации может работать одновременно
+SCHEDULER_MAX_WORKERS = int(os.getenv("SCHEDULER_MAX_WORKERS", "4"))
+# Доля слотов недельного плана с картинкой (0 — только текст)
+PLAN_IMAGE_SHARE = float(os.getenv("PLAN_IMAGE_SHARE", "0"))
+# Сколько постов в день можно опубликовать с учетом досрочных слотов
+DAILY_POST_BUDGET = int(os.getenv("DAILY_POST_BUDGET", "4"))
+# Лимит запросов к Gemini в минуту, общий для аналитика, блоггера и дайджеста
+GEMINI_RPM = int(os.getenv("GEMINI_RPM", "10"))
+# Сколько раз можно перегенерировать черновик, не прошедший проверку
+DRAFT_RETRY_BUDGET = int(os.getenv("DRAFT_RETRY_BUDGET", "2"))
+# Сколько вариантов поста просить у Gemini за слот; лишние уходят в запас черновиков
+GEMINI_CANDIDATES = int(os.getenv("GEMINI_CANDIDATES", "3"))
+# Лимит выходных токенов на все варианты одного запроса
+GENERATION_TOKEN_BUDGET = int(os.getenv("GENERATION_TOKEN_BUDGET", "3072"))
+# На сколько секунд притормозить все запросы к Gemini после ошибки генерации (429, квота)
+GEMINI_ERROR_BACKOFF = float(os.getenv("GEMINI_ERROR_BACKOFF", "20"))
+# Сколько часов черновик из запаса годится для публикации
+DRAFT_POOL_MAX_AGE_HOURS = float(os.getenv("DRAFT_POOL_MAX_AGE_HOURS", "24"))
+# Час (по Москве), когда тексты и картинки слотов плана готовятся заранее на сутки вперед
+PREFILL_HOUR = int(os.getenv("PREFILL_HOUR", "23"))
+# Пробный прогон (--dry-run): рабочая папка со своими хранилищами и записанные ответы VK и Gemini
+DRY_RUN_DIR = os.getenv("DRY_RUN_DIR", "data/dry_run")
+DRY_RUN_FIXTURES = os.getenv("DRY_RUN_FIXTURES", "data/fixtures")
+# Ротация лога: размер файла и число архивов; LOG_ROTATE_WHEN=midnight — ротация по времени
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", str(5 * 1024 * 1024)))
+LOG_BACKUP_COUNT = int(os.getenv("LOG_BACKUP_COUNT", "5"))
+LOG_ROTATE_WHEN = os.getenv("LOG_ROTATE_WHEN") or None
+# Лог строками JSON вместо текста
+LOG_JSON = os.getenv("LOG_JSON", "0") == "1"
+# Одинаковая ошибка пишется не чаще раза за столько секунд (0 — без подавления повторов)
+LOG_DEDUP_SECONDS = float(os.getenv("LOG_DEDUP_SECONDS", "300"))
+# Сколько часов доверять закешированным id и метаданным групп VK
+VK_GROUP_CACHE_HOURS = float(os.getenv("VK_GROUP_CACHE_HOURS", "24"))
+
 # ======================
 # --- ЛОГГЕР ---
 # ======================
 
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s [%(levelname)s] %(message)s",
-    handlers=[
-        logging.FileHandler("village_agent_scheduler.log"),
-        logging.StreamHandler()
-    ]
-)
+def configure_logging():
+    """
+    Вызывается только из __main__: процессы пула (spawn) заново импортируют модуль,
+    и каждый открыл бы свой обработчик того же файла лога и свой поток записи.
+    """
+    setup_logging(
+        "village_agent_scheduler.log",
+        "%(asctime)s [%(levelname)s] %(message)s",
+        max_bytes=LOG_MAX_BYTES,
+        backup_count=LOG_BACKUP_COUNT,
+        rotate_when=LOG_ROTATE_WHEN,
+        json_format=LOG_JSON,
+        dedup_seconds=LOG_DEDUP_SECONDS,
+    )
+    # APScheduler пишет каждый запуск задачи, а очередь доставки опрашивается раз в 15 секунд
+    logging.getLogger("apscheduler").setLevel(logging.WARNING)
+
+
 logger = logging.getLogger(__name__)
 
+GEMINI_LIMITER = TokenBucket(rate=GEMINI_RPM / 60, capacity=GEMINI_RPM)
+
 # ======================
 # --- VK Analytics Agent ---
 # ======================
@@ -54,64 +119,74 @@ class VKAnalyticsAgent:
     def __init__(self, access_token: str, api_version: str, group_screen_name: str, gemini_api_key: str):
         self.api = vk.API(access_token=access_token, v=api_version)
         self.group_screen_name = group_screen_name
+        self.metrics = MetricsRefresher()
+        # id групп и метаданные из общего дискового кеша, без groups.getById в каждом цикле
+        self.groups = GroupResolver(
+            lambda refs: self.api.groups.getById(group_ids=",".join(refs), fields="members_count"),
+            ttl_hours=VK_GROUP_CACHE_HOURS,
+        )
 
         _genai.configure(api_key=gemini_api_key)
         self.model = _genai.GenerativeModel("gemini-2.0-flash")
+        self.digest = WeeklyDigest(self.model, GEMINI_LIMITER, self.metrics)
 
     def fetch_posts_last_week(self) -> Tuple[List[dict], List[dict]]:
-        group_info = self.api.groups.getById(group_id=self.group_screen_name)[0]
-        owner_id = -group_info["id"]
+        """
+        Дочитывает со стены только новые посты, метрики остальных
+        берет из хранилища, где их обновляет MetricsRefresher.
+        """
         week_ago = int((datetime.now() - timedelta(days=7)).timestamp())
 
-        posts = []
-        offset = 0
-        count = 100
-
-        while True:
-            batch = self.api.wall.get(owner_id=owner_id, offset=offset, count=count)
-            if not batch.get("items"):
-                break
-
-            new_items = [item for item in batch["items"] if item["date"] >= week_ago]
-            posts.extend(new_items)
-
-            if all(item["date"] < week_ago for item in batch["items"]):
-                break
-
-            offset += count
-            time.sleep(0.34)
-
+        main_group, blog_group = self.groups.resolve_many([self.group_screen_name, VK_BLOG_GROUP])
+        posts = self._fetch_group_week(main_group.owner_id, week_ago)
         logger.info(f"Собрано постов за неделю из основной группы: {len(posts)}")
 
         # Вторая группа
-        group_info = self.api.groups.getById(group_id=VK_BLOG_GROUP)[0]
-        owner_id = -group_info["id"]
-        offset = 0
-
-        blog_posts = []
-        while True:
-            batch = self.api.wall.get(owner_id=owner_id, offset=offset, count=count)
-            if not batch.get("items"):
-                break
+        blog_posts = self._fetch_group_week(blog_group.owner_id, week_ago)
+        logger.info(f"Собрано постов за неделю из блога: {len(blog_posts)}")
 
-            new_items = [item for item in batch["items"] if item["date"] >= week_ago]
-            blog_posts.extend(new_items)
+        return posts, blog_posts
 
-            if all(item["date"] < week_ago for item in batch["items"]):
-                break
+    def _fetch_group_week(self, owner_id: int, week_ago: int) -> List[dict]:
+        since = max(week_ago, self.metrics.newest_date(owner_id) or 0)
+        new_posts = fetch_new_posts(
+            lambda offset, count: self.api.wall.get(owner_id=owner_id, offset=offset, count=count)["items"], since
+        )
+        self.metrics.track(new_posts)
+        self.refresh_metrics()
+        return self.metrics.posts_since(owner_id, week_ago)
 
-            offset += count
-            time.sleep(0.34)
+    def refresh_metrics(self):
+        """Переопрашивает посты, которые еще набирают лайки и просмотры"""
+        self.metrics.refresh(lambda ids: self.api.wall.getById(posts=",".join(ids)))
 
-        logger.info(f"Собрано постов за неделю из блога: {len(blog_posts)}")
+    def blog_history(self) -> List[dict]:
+        """Посты блога за неделю из хранилища метрик, без чтения стены"""
+        week_ago = int((datetime.now() - timedelta(days=7)).timestamp())
+        return self.metrics.posts_since(self.groups.owner_id(VK_BLOG_GROUP), week_ago)
 
-        return posts, blog_posts
+    def write_weekly_digest(self) -> str:
+        """Недельный выпуск новостей основной группы в data/week_<дата>.txt"""
+        date_today = datetime.now().date()
+        # Окно от полуночи: пачки по дням совпадают с прошлыми запусками и берутся из кеша
+        week_start = datetime.combine(date_today - timedelta(days=7), datetime.min.time())
+        owner_id = self.groups.owner_id(self.group_screen_name)
+        self._fetch_group_week(owner_id, int(week_start.timestamp()))
+        return self.digest.write(
+            owner_id,
+            int(week_start.timestamp()),
+            f'data/week_{date_today}.txt',
+            f'Список новостей за неделю в Граховском районе и не только. Выпуск за {date_today}',
+        )
 
     def get_best_topics_and_times(self, posts: List[dict], blog_posts: List[dict]) -> Tuple[List[str], List[str]]:
         """Рекомендует список тем и оптимальное время публикации"""
+        combined_text, combined_blog = self.aggregate_posts(posts, blog_posts)
+        return self.recommend_topics(combined_text), combined_blog
+
+    def aggregate_posts(self, posts: List[dict], blog_posts: List[dict]) -> Tuple[str, str]:
+        """Сводки постов группы и блога с метриками для промптов (локально, без запросов)"""
         posts_summary = []
-        date_today = datetime.now().date()
-        full_posts = [f'Список новостей за неделю в Граховском районе и не только. Выпуск за {date_today}']
         # print('-------')
         # print(len(posts))
         # print('-------')
@@ -124,19 +199,18 @@ class VKAnalyticsAgent:
             # print(text[:80])
             
             like_str = f"| Лайки: {likes} | Репосты: {reposts} | Просмотры: {views}"
-            full_posts.append(f"{text}\n{like_str}")
             like_str = f"{date} | «{text[:80]}...» " + like_str
             posts_summary.append(
                 like_str
             )
         print('---------------------------------------')
-        if datetime.now().weekday() == 2:
-            
-            with open(f'data/week_{date_today}.txt', 'w', encoding='utf-8') as f:
-                f.write('\n'.join(full_posts))
         combined_text = "\n".join(posts_summary)
         if len(combined_text) > 2000:
             combined_text = combined_text[:2000]
+        return combined_text, self.summarize_blog(blog_posts)
+
+    def summarize_blog(self, blog_posts: List[dict]) -> str:
+        """Сводка уже написанных постов блога для промпта генерации"""
         blog_post_summary = []
         for p in blog_posts:
             text = p["text"].replace("\n", " ").strip()
@@ -144,13 +218,16 @@ class VKAnalyticsAgent:
             reposts = p["reposts"]["count"]
             views = p.get("views", {}).get("count", 0)
             date = datetime.fromtimestamp(p["date"]).strftime('%Y-%m-%d %H:%M')
-            full_posts.append(text)
             blog_post_summary.append(
                 f"{date} | «{text[:80]}...» | Лайки: {likes} | Репосты: {reposts} | Просмотры: {views}"
             )
         combined_blog = '\n'.join(blog_post_summary)
         if len(combined_blog) > 1000:
             combined_blog = combined_blog[:1000]
+        return combined_blog
+
+    def recommend_topics(self, combined_text: str) -> str:
+        """Темы и время публикации от Gemini в формате «тема | время»"""
         prompt = (
             "Ты аналитик SMM. Вот посты за неделю:\n"
             f"{combined_text}\n\n"
@@ -165,6 +242,7 @@ class VKAnalyticsAgent:
         
         # blog_post_summary = f'{blog_post_summary}'
         # prompt += blog_post_summary
+        GEMINI_LIMITER.acquire()
         response_txt = self.model.generate_content(prompt).text.strip()
         # print('----------------------')
         # print(response_txt)
@@ -180,7 +258,7 @@ class VKAnalyticsAgent:
 
         # logger.info(f"Аналитик рекомендует: {topics} / {timings}")
         
-        return response_txt, combined_blog
+        return response_txt
 
 
 # ======================
@@ -189,27 +267,44 @@ class VKAnalyticsAgent:
 
 class VillageContentGenerator:
     """Блоггер с ориентацией по времени и аналитикой"""
-    def __init__(self, gemini_api_key: str, analytics_agent: VKAnalyticsAgent):
+    def __init__(self, gemini_api_key: str, analytics_agent: VKAnalyticsAgent, workers: ProcessWorkers = None):
         self.api_key = gemini_api_key
         self.analytics_agent = analytics_agent
+        self.workers = workers or ProcessWorkers()
+        self.journal = PublishJournal()
+        self.drafts = DraftPool(max_age_hours=DRAFT_POOL_MAX_AGE_HOURS)
+        self.delivery = DeliveryQueue(
+            senders={
+                "telegram": TelegramSender(TG_BOT_TOKEN),
+                "vk": VKSender(VK_ACCESS_TOKEN, VK_API_VERSION),
+            },
+            journal=self.journal,
+        )
 
         _genai.configure(api_key=gemini_api_key)
         self.model = _genai.GenerativeModel('gemini-2.0-flash')
+        # Клиент для картинок; None — новый genai.Client на каждый запрос
+        self.image_client = None
 
         self.system_prompt = """
         Ты — блоггер из деревни Иван. Пиши теплые, жизненные посты без пафоса.
         Формат — история или размышление без вопросов к читателю.
         Объем — 400-500 символов.
         """
+        # Персонаж пишет «без вопросов к читателю»
+        self.scorer = DraftScorer(self.system_prompt, allow_questions=False)
+        self.planner = ContentPlanner(analytics_agent, self._get_time_context, image_share=PLAN_IMAGE_SHARE)
 
-    def generate_image_post(self, topic: str, save_path: str = "data/post_image.png") -> Tuple[str, str]:
+    def generate_image_post(
+        self, topic: str, save_path: str = "data/post_image.png", time_context: str = None
+    ) -> Tuple[str, str]:
         """
         Генерирует пост с изображением по теме.
         Возвращает текст поста и путь к сохраненному изображению.
         """
         from google import genai
-        time_context = self._get_time_context()
-        client_ = genai.Client(api_key=GEMINI_API_KEY)
+        time_context = time_context or self._get_time_context()
+        client_ = self.image_client or genai.Client(api_key=GEMINI_API_KEY)
 
         prompt = (
             f"Ты — художник из деревни. "
@@ -228,23 +323,22 @@ class VillageContentGenerator:
                 response_modalities=['TEXT', 'IMAGE']
                 )
             )
-            image = None
             text = "Скоро появится чудесное изображение деревенской жизни."
 
             for part in response.candidates[0].content.parts:
                 if part.text is not None:
                     text = part.text.strip()
                 elif part.inline_data is not None:
-                    image = Image.open(BytesIO(part.inline_data.data))
-                    image.save(save_path)
+                    # Декодирование и сохранение PIL — в процессе-воркере
+                    self.workers.save_image(part.inline_data.data, save_path)
             return text, save_path
         except Exception as e:
             logger.error(f"Ошибка генерации изображения: {e}")
             return f"Сегодня поговорим о {topic}.", None
 
 
-    def get_season(self):
-        month = datetime.now().month
+    def get_season(self, at: datetime = None):
+        month = (at or datetime.now(MOSCOW_TZ)).month
         if month in [12]:
             return 'Декабрь зима'
         elif month in [1]:
@@ -270,23 +364,24 @@ class VillageContentGenerator:
         elif month in [11]:
             return 'Ноябрь осень'
 
-    def _get_time_context(self) -> str:
-        now = datetime.now()
-        hour = now.hour + 3
+    def _get_time_context(self, at: datetime = None) -> str:
+        # Время слота по Москве, независимо от часового пояса сервера
+        now = at or datetime.now(MOSCOW_TZ)
+        hour = now.hour
         weekday = now.weekday()
-        if hour < 8:
+        if hour < 9:
             day_part = "утро"
-        elif 9 <= hour < 17:
+        elif hour < 17:
             day_part = "день"
         else:
             day_part = "вечер"
 
         weekend = "выходные" if weekday >= 5 else "будни"
-        season = self.get_season()
+        season = self.get_season(now)
         return f"{day_part}, {weekend}, {season}"
 
-    def generate_post(self, topic: str,  old_blog_posts: str) -> str:
-        time_context = self._get_time_context()
+    def _post_prompt(self, topic: str, old_blog_posts: str, feedback: str = None, time_context: str = None) -> str:
+        time_context = time_context or self._get_time_context()
         prompt = (
             f"{self.system_prompt}\n\n"
             f"Сейчас: {time_context}\n\n"
@@ -296,171 +391,358 @@ class VillageContentGenerator:
             f"А эти посты ты уже писал: {old_blog_posts}\n"
             "Напиши пост."
         )
+        if feedback:
+            prompt += f"\nПрошлый вариант отклонен: {feedback}. Исправь это."
         # print("=================")
         # print(prompt)
         # print("==================")
+        return prompt
+
+    def generate_post(self, topic: str,  old_blog_posts: str, feedback: str = None, time_context: str = None) -> str:
+        prompt = self._post_prompt(topic, old_blog_posts, feedback, time_context)
         try:
+            GEMINI_LIMITER.acquire()
             response = self.model.generate_content(prompt)
             return response.text
+        except RateLimitTimeout:
+            raise
         except Exception as e:
             logger.error(f"Ошибка генерации поста: {e}")
-            return f"Сегодня поговорим о {topic}."
-        
-    def post_image_to_vk(self, text: str, image_path: str):
-        # 1. Получить upload_url
-        upload_url_resp = requests.get("https://api.vk.com/method/photos.getWallUploadServer", params={
-            "access_token": VK_ACCESS_TOKEN,
-            "v": VK_API_VERSION,
-            "group_id": VK_GROUP_ID,
-        }).json()
-
-        upload_url = upload_url_resp["response"]["upload_url"]
-
-        # 2. Загрузить фото
-        with open(image_path, "rb") as img_file:
-            upload_resp = requests.post(upload_url, files={"photo": img_file}).json()
-
-        # 3. Сохранить фото
-        save_photo_resp = requests.get("https://api.vk.com/method/photos.saveWallPhoto", params={
-            "access_token": VK_ACCESS_TOKEN,
-            "v": VK_API_VERSION,
-            "group_id": VK_GROUP_ID,
-            "photo": upload_resp["photo"],
-            "server": upload_resp["server"],
-            "hash": upload_resp["hash"],
-        }).json()
-
-        photo_info = save_photo_resp["response"][0]
-        attachment = f"photo{photo_info['owner_id']}_{photo_info['id']}"
-
-        # 4. Опубликовать пост
-        vk_signature = "\n\n👉 Подписывайтесь на нас!"
-        post_resp = requests.get("https://api.vk.com/method/wall.post", params={
-            "access_token": VK_ACCESS_TOKEN,
-            "v": VK_API_VERSION,
-            "owner_id": f"-{VK_GROUP_ID}",
-            "message": text + vk_signature,
-            "attachments": attachment,
-            "from_group": 1,
-        }).json()
-
-        logger.info(f"Фото-пост опубликован в ВК: {post_resp}")
-
-    def post_to_vk(self, text: str):
+            raise
+
+    def generate_posts(
+        self, topic: str, old_blog_posts: str, count: int = 1, feedback: str = None, time_context: str = None
+    ) -> List[str]:
+        """
+        Несколько вариантов поста за один запрос (candidate_count) в пределах GENERATION_TOKEN_BUDGET.
+        Если модель вернула меньше вариантов, добирает параллельными запросами,
+        но только пока в лимите Gemini есть свободные токены — остальных не задерживаем.
+        При ошибке API ничего не добирает: притормаживает общий лимит и возвращает пустой список.
+        """
+        prompt = self._post_prompt(topic, old_blog_posts, feedback, time_context)
+        max_tokens = GENERATION_TOKEN_BUDGET // count
+        texts = []
         try:
-            vk_signature = "\n\n👉 Подписаться на Сельский Блогер: https://t.me/selhozblogger"
-            
-            response = self.analytics_agent.api.wall.post(
-                owner_id=VK_GROUP_ID,
-                from_group=1,
-                message=f"{text}{vk_signature}"
+            GEMINI_LIMITER.acquire()
+            response = self.model.generate_content(
+                prompt, generation_config={"candidate_count": count, "max_output_tokens": max_tokens}
             )
-            logger.info(f"Пост опубликован в VK: {response}")
+            for candidate in response.candidates:
+                text = "".join(part.text for part in candidate.content.parts if getattr(part, "text", None))
+                if text.strip():
+                    texts.append(text)
+        except RateLimitTimeout:
+            raise
         except Exception as e:
-            logger.error(f"Ошибка публикации в VK: {e}")
+            # Во время 429 добор отдельными запросами только продлит сбой
+            GEMINI_LIMITER.penalize(GEMINI_ERROR_BACKOFF)
+            logger.error(f"Ошибка генерации {count} вариантов поста: {e}")
+            return []
+
+        def generate_one() -> str:
+            return self.model.generate_content(prompt, generation_config={"max_output_tokens": max_tokens}).text
+
+        extra = sum(1 for _ in range(count - len(texts)) if GEMINI_LIMITER.try_acquire())
+        if extra:
+            with ThreadPoolExecutor(extra) as executor:
+                for future in [executor.submit(generate_one) for _ in range(extra)]:
+                    try:
+                        texts.append(future.result())
+                    except Exception as e:
+                        logger.error(f"Ошибка генерации поста: {e}")
+
+        return texts
+
+    def _deliver(self, platform: str, target: str, kind: str, payload: dict, journal_key: str = None):
+        """Ставит публикацию в очередь доставки и сразу отправляет то, что позволяют лимиты"""
+        destination = f"{platform}:{target}"
+        if journal_key and (
+            self.journal.finished(journal_key, destination) or self.delivery.has_job(journal_key, destination)
+        ):
+            return
+        # Сначала задание, потом журнал: падение между записями оставит задание в очереди, а не потеряет пост
+        self.delivery.enqueue(destination, kind, payload, group_key=journal_key, journal_key=journal_key)
+        if journal_key:
+            self.journal.mark_queued(journal_key, destination)
+        # Если очередь уже разбирает другой поток или задача шедулера, отправит она
+        self.delivery.drain(wait=False)
+
+    def _vk_target(self) -> str:
+        """Положительный id группы VK: VK_GROUP_ID можно задать как '-123', '123' или короткое имя"""
+        return str(self.analytics_agent.groups.group_id(VK_GROUP_ID))
+
+    def post_image_to_vk(self, text: str, image_path: str, journal_key: str = None):
+        vk_signature = "\n\n👉 Подписывайтесь на нас!"
+        self._deliver("vk", self._vk_target(), "photo", {"caption": text + vk_signature, "path": image_path}, journal_key)
+
+    def post_to_vk(self, text: str, journal_key: str = None):
+        vk_signature = "\n\n👉 Подписаться на Сельский Блогер: https://t.me/selhozblogger"
+        self._deliver("vk", self._vk_target(), "text", {"text": f"{text}{vk_signature}"}, journal_key)
 
-    def post_image_to_telegram(self, text: str, image_path: str):
-        url = f"https://api.telegram.org/bot{TG_BOT_TOKEN}/sendPhoto"
+    def post_image_to_telegram(self, text: str, image_path: str, journal_key: str = None):
         telegram_signature = "\n\n<a href=\"https://t.me/selhozblogger\">👉 Подписаться на Сельский Блогер</a>"
-        data = {
-            "chat_id": TG_CHAT_ID,
-            "caption": f"{text}{telegram_signature}",
-            "parse_mode": "HTML"
-        }
-        try:
-            with open(image_path, "rb") as photo:
-                files = {"photo": photo}
-                response = requests.post(url, data=data, files=files)
-                response.raise_for_status()
-                logger.info(f"Фото-пост опубликован в Telegram: {response.json()}")
-        except Exception as e:
-            logger.error(f"Ошибка публикации фото в Telegram: {e}")
+        for chat_id in TG_CHAT_IDS:
+            self._deliver("telegram", chat_id, "photo",
+                          {"caption": f"{text}{telegram_signature}", "path": image_path}, journal_key)
 
-    def post_to_telegram(self, text: str):
-        url = f"https://api.telegram.org/bot{TG_BOT_TOKEN}/sendMessage"
+    def post_to_telegram(self, text: str, journal_key: str = None):
         telegram_signature = "\n\n<a href=\"https://t.me/selhozblogger\">👉 Подписаться на Сельский Блогер</a>"
-        payload = {
-            "chat_id": TG_CHAT_ID,
-            "text": f"{text}{telegram_signature}",
-            "parse_mode": "HTML",
-        }
-        try:
-            response = requests.post(url, json=payload)
-            response.raise_for_status()
-            logger.info(f"Пост опубликован в Telegram: {response.json()}")
-        except Exception as e:
-            logger.error(f"Ошибка публикации в Telegram: {e}")
+        for chat_id in TG_CHAT_IDS:
+            self._deliver("telegram", chat_id, "text", {"text": f"{text}{telegram_signature}"}, journal_key)
 
-    def run_posting_cycle(self):
-        """Запрашивает новые темы, пишет пост и публикует"""
-        posts, blog_posts = self.analytics_agent.fetch_posts_last_week()
-        topics, old_blog_posts = self.analytics_agent.get_best_topics_and_times(posts, blog_posts)
-        
-        if not topics:
-            logger.warning("Нет тем для фото-поста.")
-            return
-    
-        # topic = topics[0]
-        if not topics:
-            logger.warning("Нет рекомендаций от аналитика, публикую на общую тему.")
-            topic = "деревенская жизнь"
-        else:
-            topic = topics
-        # text, image_path = self.generate_image_post(topic)
-        
-        # if image_path:
-        #     self.post_image_to_telegram(text, image_path)
-        #     self.post_image_to_vk(text, image_path)
-        # else:
-        #     self.post_to_telegram(text)
-        #     self.post_to_vk(text)
-        post = self.generate_post(topic,  old_blog_posts)
-        # print('-------------------')
-        # print(post)
-        # print('-------------------')
-        self.post_to_vk(post)
-        self.post_to_telegram(post)
+    def run_posting_cycle(self, deadline: Deadline = None, slot_at: datetime = None) -> CycleResult:
+        """
+        Один цикл публикации вне шедулера (ручной запуск).
+        Шедулер гоняет тот же конвейер в общем event loop для всех групп.
+        """
+        pipeline = PostingPipeline(
+            draft_retry_budget=DRAFT_RETRY_BUDGET, candidates=GEMINI_CANDIDATES, workers=self.workers
+        )
+        return asyncio.run(pipeline.run_cycle(self, VK_GROUP_ID, slot_at, deadline))
 
 
 # ======================
 # --- Шедулер ---
 # ======================
 
-def start_scheduler():
+def schedule_tenant(scheduler, pipeline: PostingPipeline, guard: JobGuard, tenant: str, blogger: VillageContentGenerator):
+    """Слоты, адаптивная частота и служебные задачи одной группы"""
+    vk_agent = blogger.analytics_agent
+    owner_id = vk_agent.groups.owner_id(tenant)
+    controller = PostingController(
+        vk_agent.metrics,
+        owner_id,
+        poll_latest=lambda: vk_agent.api.wall.get(owner_id=owner_id, count=2)["items"],
+        daily_budget=DAILY_POST_BUDGET,
+    )
+    # Слоты, уже опубликованные досрочно
+    advanced_slots = set()
+
+    async def run_slot(slot_at: datetime):
+        await guard.run(
+            tenant,
+            lambda deadline: pipeline.run_cycle(blogger, tenant, slot_at, deadline),
+            deadline=next_slot(scheduler, tenant),
+        )
+
+    async def scheduled_cycle():
+        slot_at = datetime.now(MOSCOW_TZ).replace(minute=0, second=0, microsecond=0)
+        if slot_at in advanced_slots:
+            advanced_slots.discard(slot_at)
+            logger.info(f"[{tenant}] Слот уже опубликован досрочно, пропускаю")
+            return
+
+        decision = await asyncio.to_thread(controller.decide)
+        logger.info(f"[{tenant}] Адаптивная частота: {decision.action} — {decision.reason}")
+        if decision.action == SKIP:
+            await asyncio.to_thread(blogger.planner.mark, slot_at, "skipped")
+        elif decision.action == DELAY:
+            scheduler.add_job(
+                run_slot, 'date',
+                run_date=datetime.now(MOSCOW_TZ) + timedelta(minutes=decision.delay_minutes),
+                args=[slot_at], id=f"delayed-{tenant}-{slot_at:%Y%m%d%H}", replace_existing=True,
+            )
+        else:
+            await run_slot(slot_at)
+
+    async def check_momentum():
+        """
+        Переносит следующий слот пораньше, если последний пост хорошо заходит.
+        Только внутри дня: после прошлого слота плюс min_gap_hours и до следующего,
+        чтобы утренний слот не ушел на ночь.
+        """
+        now = datetime.now(MOSCOW_TZ)
+        upcoming = next_slot(scheduler, tenant)
+        if not upcoming:
+            return
+        upcoming = upcoming.astimezone(MOSCOW_TZ)
+        if upcoming.date() != now.date() or upcoming - now < timedelta(hours=1):
+            return
+        today = now.date()
+        earlier = [
+            at for at in blogger.planner.slot_times(today - timedelta(days=today.weekday()))
+            if at.date() == today and at < now
+        ]
+        if not earlier or now - earlier[-1] < timedelta(hours=controller.min_gap_hours):
+            return
+        decision = await asyncio.to_thread(controller.decide)
+        if decision.action != ADVANCE:
+            return
+        logger.info(f"[{tenant}] Адаптивная частота: слот {upcoming} переносится пораньше — {decision.reason}")
+        slot_at = upcoming.replace(minute=0, second=0, microsecond=0)
+        advanced_slots.add(slot_at)
+        await run_slot(slot_at)
+
+    # Расписание: утром, днем, вечером по будням, в выходные только утром
+    for day_of_week, hour in POSTING_SLOTS:
+        scheduler.add_job(scheduled_cycle, 'cron', day_of_week=day_of_week, hour=hour, id=f"{tenant}:{day_of_week}-{hour}")
+
+    # Проверка, не пора ли опубликовать следующий слот раньше
+    scheduler.add_job(check_momentum, 'interval', minutes=30, id=f"momentum-{tenant}")
+
+    # План на следующую неделю строится в воскресенье вечером, текущая — при старте
+    scheduler.add_job(blogger.planner.plan_next_week, 'cron', day_of_week='sun', hour=22, id=f"weekly-plan-{tenant}")
+
+    # Тексты и картинки слотов плана на сутки вперед — ночью, когда слотов нет
+    async def prefill_slots():
+        await guard.run(tenant, lambda deadline: pipeline.prefill(blogger, tenant), deadline=next_slot(scheduler, tenant))
+
+    scheduler.add_job(prefill_slots, 'cron', hour=PREFILL_HOUR, id=f"prefill-{tenant}")
+    try:
+        blogger.planner.ensure_current_week()
+    except Exception as e:
+        logger.error(f"[{tenant}] Не удалось составить план недели, слоты пойдут без плана: {e}")
+
+    # Метрики свежих постов: опрашиваются только посты в окне роста
+    scheduler.add_job(vk_agent.refresh_metrics, 'interval', minutes=30, id=f"metrics-{tenant}")
+
+    # Повторы отложенных и упавших отправок из очереди доставки
+    scheduler.add_job(blogger.delivery.drain, 'interval', seconds=15, id=f"delivery-{tenant}")
+
+    # Недельный дайджест по средам, до первого слота
+    scheduler.add_job(vk_agent.write_weekly_digest, 'cron', day_of_week='wed', hour=6, id=f"weekly-digest-{tenant}")
+
+
+def build_blogger(workers: ProcessWorkers, fixtures: Fixtures = None, latency: float = 0.0) -> VillageContentGenerator:
+    """
+    Аналитик и блоггер. С fixtures — пробный режим: VK и Gemini отвечают из записей
+    (или из сети с записью), а площадки подменены записывающими отправителями.
+    """
     vk_agent = VKAnalyticsAgent(
         access_token=VK_ACCESS_TOKEN,
         api_version=VK_API_VERSION,
         group_screen_name=VK_GROUP_SCREEN_NAME,
         gemini_api_key=GEMINI_API_KEY
     )
-
     blogger = VillageContentGenerator(
         gemini_api_key=GEMINI_API_KEY,
-        analytics_agent=vk_agent
+        analytics_agent=vk_agent,
+        workers=workers,
     )
-    # blogger.run_posting_cycle()
-    scheduler = BackgroundScheduler(timezone=timezone('Europe/Moscow'))
+    if fixtures:
+        def image_client():
+            # Только для записи: при воспроизведении клиент не нужен, и google-genai может быть не установлен
+            from google import genai
+            return genai.Client(api_key=GEMINI_API_KEY)
+
+        vk_agent.api = RecordedVKAPI(vk_agent.api, fixtures)
+        vk_agent.digest.model = RecordedModel(vk_agent.model, fixtures, "digest")
+        vk_agent.model = RecordedModel(vk_agent.model, fixtures, "recommend")
+        blogger.model = RecordedModel(blogger.model, fixtures, "generate_post")
+        blogger.image_client = RecordedImageClient(image_client, fixtures)
+        blogger.delivery.senders = {
+            "telegram": RecordingSender("telegram", latency),
+            "vk": RecordingSender("vk", latency),
+        }
+        logger.info(f"Пробный режим: ответы {'записываются в' if fixtures.record else 'берутся из'} {fixtures.path}, публикации только записываются")
+    return blogger
+
+
+def run_dry_cycles(fixtures: Fixtures, tenants: int = 1, latency: float = 0.0) -> dict:
+    """
+    Один цикл публикации сразу для tenants групп через общий конвейер и JobGuard,
+    как в шедулере. Дополнительные группы имитируются копиями основной.
+    Отчет с таймингами этапов и перехваченными отправками — в data/report_<время>.json.
+    """
+    workers = ProcessWorkers(WORKER_PROCESSES)
+    try:
+        blogger = build_blogger(workers, fixtures, latency)
+        pipeline = PostingPipeline(draft_retry_budget=DRAFT_RETRY_BUDGET, candidates=GEMINI_CANDIDATES, workers=workers)
+        guard = JobGuard(max_workers=SCHEDULER_MAX_WORKERS)
+        tenant_ids = [VK_GROUP_ID] + [f"{VK_GROUP_ID}-sim{i}" for i in range(1, tenants)]
+        cycles = []
+
+        async def run_tenant(tenant: str):
+            async def cycle(deadline: Deadline):
+                result = await pipeline.run_cycle(blogger, tenant, deadline=deadline)
+                cycles.append({
+                    "tenant": tenant,
+                    "journal_key": result.journal_key,
+                    "published": result.published,
+                    "stages": {
+                        name: {"ok": stage.ok, "error": stage.error, "elapsed": round(stage.elapsed, 3)}
+                        for name, stage in result.stages.items()
+                    },
+                })
+            await guard.run(tenant, cycle)
+
+        async def run_all():
+            await asyncio.gather(*(run_tenant(tenant) for tenant in tenant_ids))
+            # Отложенные лимитом площадки отправки тоже дожидаемся
+            while blogger.delivery.drain() or blogger.delivery.pending():
+                await asyncio.sleep(1)
+
+        started = time.monotonic()
+        asyncio.run(run_all())
+        elapsed = time.monotonic() - started
+        report_path = f"data/report_{datetime.now():%Y%m%d_%H%M%S}.json"
+        report = write_report(report_path, cycles, blogger.delivery.senders, elapsed)
+        logger.info(
+            f"Пробный прогон: {len(tenant_ids)} групп за {elapsed:.1f} с, "
+            f"опубликовано бы {sum(c['published'] for c in cycles)}, отправок {len(report['sent'])}. "
+            f"Отчет: {os.path.abspath(report_path)}"
+        )
+        return report
+    finally:
+        workers.shutdown()
 
-    # Расписание: утром, днем, вечером по будням
-    scheduler.add_job(blogger.run_posting_cycle, 'cron', day_of_week='mon-fri', hour=7)
-    scheduler.add_job(blogger.run_posting_cycle, 'cron', day_of_week='mon-fri', hour=13)
-    scheduler.add_job(blogger.run_posting_cycle, 'cron', day_of_week='mon-fri', hour=19)
 
-    # В выходные только утром
-    scheduler.add_job(blogger.run_posting_cycle, 'cron', day_of_week='sat,sun', hour=11)
+def start_scheduler(fixtures: Fixtures = None, latency: float = 0.0):
+    workers = ProcessWorkers(WORKER_PROCESSES)
+    blogger = build_blogger(workers, fixtures, latency)
+    # blogger.run_posting_cycle()
+    # Один event loop ведет циклы всех групп; пропущенные слоты схлопываются
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    scheduler = AsyncIOScheduler(
+        event_loop=loop,
+        timezone=MOSCOW_TZ,
+        job_defaults={'coalesce': True, 'max_instances': 1, 'misfire_grace_time': 15 * 60},
+    )
+    pipeline = PostingPipeline(draft_retry_budget=DRAFT_RETRY_BUDGET, candidates=GEMINI_CANDIDATES, workers=workers)
+    guard = JobGuard(max_workers=SCHEDULER_MAX_WORKERS)
+
+    tenants = {VK_GROUP_ID: blogger}
+    for tenant, tenant_blogger in tenants.items():
+        schedule_tenant(scheduler, pipeline, guard, tenant, tenant_blogger)
 
     scheduler.start()
     logger.info("Шедулер запущен.")
 
     try:
-        while True:
-            time.sleep(60)
+        loop.run_forever()
     except (KeyboardInterrupt, SystemExit):
         scheduler.shutdown()
+        workers.shutdown()
 
 
 if __name__ == "__main__":
-    start_scheduler()
+    parser = argparse.ArgumentParser(description="Агент-аналитик и сельский блоггер")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="прогон без публикаций: VK и Gemini из записанных ответов, отправки только записываются")
+    parser.add_argument("--record", action="store_true",
+                        help="в пробном прогоне брать ответы VK и Gemini из сети и сохранять их для повторов")
+    parser.add_argument("--schedule", action="store_true",
+                        help="пробный прогон по расписанию шедулера вместо одного цикла")
+    parser.add_argument("--tenants", type=int, default=1,
+                        help="сколько групп имитировать в пробном цикле")
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="имитация времени ответа площадки в пробном прогоне, с")
+    args = parser.parse_args()
+    configure_logging()
+
+    if args.dry_run:
+        fixtures = Fixtures(os.path.abspath(DRY_RUN_FIXTURES), record=args.record)
+        # Все хранилища пишут в data/ относительно рабочей папки: журнал, очередь
+        # и запас черновиков пробного прогона не смешиваются с настоящими
+        os.makedirs(DRY_RUN_DIR, exist_ok=True)
+        os.chdir(DRY_RUN_DIR)
+        if args.schedule:
+            start_scheduler(fixtures, args.latency)
+        else:
+            run_dry_cycles(fixtures, args.tenants, args.latency)
+    else:
+        start_scheduler()
     # vk_agent = VKAnalyticsAgent(
     #     access_token=VK_ACCESS_TOKEN,
     #     api_version=VK_API_VERSION,
@@ -0,0 +1,188 @@
+import os
+import json
+import logging
+from datetime import date, datetime, timedelta
+from typing import Callable, Dict, List, Optional, Tuple
+
+from pytz import timezone
+
+logger = logging.getLogger(__name__)
+
+MOSCOW_TZ = timezone('Europe/Moscow')
+
+# Слоты публикации в формате cron APScheduler: (дни недели, час)
+POSTING_SLOTS = [
+    ("mon-fri", 7),
+    ("mon-fri", 13),
+    ("mon-fri", 19),
+    ("sat,sun", 11),
+]
+
+WEEKDAYS = ["mon", "tue", "wed", "thu", "fri", "sat", "sun"]
+
+
+def parse_days(spec: str) -> List[int]:
+    """'mon-fri' / 'sat,sun' -> номера дней недели (пн = 0)"""
+    days = []
+    for part in spec.split(","):
+        if "-" in part:
+            start, end = part.split("-")
+            days.extend(range(WEEKDAYS.index(start), WEEKDAYS.index(end) + 1))
+        else:
+            days.append(WEEKDAYS.index(part))
+    return days
+
+
+def parse_recommendations(response_txt: str) -> List[Tuple[str, str]]:
+    """Строки аналитика «тема | время» -> [(тема, время)]"""
+    recommendations = []
+    for line in (response_txt or "").splitlines():
+        if "|" in line:
+            topic, timing = line.split("|", 1)
+            topic = topic.strip(" -*0123456789.")
+            if topic:
+                recommendations.append((topic, timing.strip().lower()))
+    return recommendations
+
+
+def _timing_fits(timing: str, at: datetime) -> bool:
+    """Подходит ли рекомендация аналитика («вечер, будни») под время слота"""
+    weekend = at.weekday() >= 5
+    if "выходн" in timing and not weekend or "будн" in timing and weekend:
+        return False
+    if "утр" in timing and at.hour >= 12 or "вечер" in timing and at.hour < 17:
+        return False
+    return True
+
+
+class ContentPlanner:
+    """
+    Планирует неделю вперед за один проход: каждому слоту назначаются тема,
+    контекст времени и сезона и выбор «с картинкой / без». Аналитика
+    считается раз в неделю, а не на каждом слоте. План хранится в JSON,
+    его можно посмотреть и поправить руками до наступления слота.
+    """
+    def __init__(
+        self,
+        analytics_agent,
+        time_context: Callable[[datetime], str],
+        slots: List[Tuple[str, int]] = POSTING_SLOTS,
+        image_share: float = 0.0,
+        calendar_dir: str = "data/calendar",
+    ):
+        self.analytics_agent = analytics_agent
+        self.time_context = time_context
+        self.slots = slots
+        self.image_share = image_share
+        self.calendar_dir = calendar_dir
+        os.makedirs(calendar_dir, exist_ok=True)
+
+    def _path(self, week_start: date) -> str:
+        year, week, _ = week_start.isocalendar()
+        return os.path.join(self.calendar_dir, f"{year}-W{week:02d}.json")
+
+    def slot_times(self, week_start: date) -> List[datetime]:
+        """Все слоты недели, начиная с понедельника week_start, по порядку"""
+        times = []
+        for day_spec, hour in self.slots:
+            for weekday in parse_days(day_spec):
+                day = week_start + timedelta(days=weekday)
+                times.append(MOSCOW_TZ.localize(datetime(day.year, day.month, day.day, hour)))
+        return sorted(times)
+
+    def plan_week(self, week_start: date) -> Dict:
+        """Строит и сохраняет план недели: одна аналитика на все слоты"""
+        posts, blog_posts = self.analytics_agent.fetch_posts_last_week()
+        response_txt, old_blog_posts = self.analytics_agent.get_best_topics_and_times(posts, blog_posts)
+        recommendations = parse_recommendations(response_txt) or [("деревенская жизнь", "")]
+
+        times = self.slot_times(week_start)
+        image_every = round(1 / self.image_share) if self.image_share else 0
+        used = {topic: 0 for topic, _ in recommendations}
+        slots = []
+        for i, at in enumerate(times):
+            # Из подходящих по времени тем берем наименее использованную
+            fitting = [r for r in recommendations if _timing_fits(r[1], at)] or recommendations
+            topic, timing = min(fitting, key=lambda r: used[r[0]])
+            used[topic] += 1
+            slots.append({
+                "at": at.isoformat(),
+                "topic": f"{topic} | {timing}" if timing else topic,
+                "time_context": self.time_context(at),
+                "with_image": bool(image_every) and i % image_every == image_every - 1,
+                "status": "planned",
+            })
+
+        plan = {
+            "week_start": week_start.isoformat(),
+            "created_at": datetime.now(MOSCOW_TZ).isoformat(),
+            "old_blog_posts": old_blog_posts,
+            "slots": slots,
+        }
+        self._save(plan)
+        logger.info(f"Составлен план на неделю с {week_start}: {len(slots)} слотов")
+        return plan
+
+    def _save(self, plan: Dict):
+        path = self._path(date.fromisoformat(plan["week_start"]))
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(plan, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, path)
+
+    def load(self, week_start: date) -> Optional[Dict]:
+        path = self._path(week_start)
+        if not os.path.exists(path):
+            return None
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+
+    def plan_next_week(self) -> Dict:
+        today = datetime.now(MOSCOW_TZ).date()
+        return self.plan_week(today + timedelta(days=7 - today.weekday()))
+
+    def ensure_current_week(self) -> Dict:
+        """План текущей недели; если его нет (первый запуск), строит"""
+        today = datetime.now(MOSCOW_TZ).date()
+        week_start = today - timedelta(days=today.weekday())
+        return self.load(week_start) or self.plan_week(week_start)
+
+    def slot_for(self, at: Optional[datetime] = None) -> Tuple[Optional[Dict], Optional[Dict]]:
+        """План недели и запись слота, ближайшего к моменту at (в пределах часа)"""
+        at = at or datetime.now(MOSCOW_TZ)
+        plan = self.load(at.date() - timedelta(days=at.weekday()))
+        if not plan:
+            return None, None
+        for slot in plan["slots"]:
+            if abs((datetime.fromisoformat(slot["at"]) - at).total_seconds()) < 3600:
+                return plan, slot
+        return plan, None
+
+    def upcoming(self, since: datetime, until: datetime) -> List[Dict]:
+        """Еще не отработанные слоты планов в интервале [since, until)"""
+        slots = []
+        week_start = since.date() - timedelta(days=since.weekday())
+        while week_start <= until.date():
+            plan = self.load(week_start)
+            for slot in plan["slots"] if plan else []:
+                if slot["status"] == "planned" and since <= datetime.fromisoformat(slot["at"]) < until:
+                    slots.append(slot)
+            week_start += timedelta(days=7)
+        return slots
+
+    def mark(self, at: datetime, status: str):
+        """Отмечает результат слота в плане; у пропущенного слота удаляет заготовленную картинку"""
+        plan, slot = self.slot_for(at)
+        if slot:
+            slot["status"] = status
+            self._save(plan)
+            image_path = slot.get("image_path")
+            if status == "skipped" and image_path and os.path.exists(image_path):
+                os.remove(image_path)
+
+    def attach_image(self, at: datetime, image_path: str):
+        """Запоминает картинку, нарисованную для слота заранее"""
+        plan, slot = self.slot_for(at)
+        if slot:
+            slot["image_path"] = image_path
+            self._save(plan)
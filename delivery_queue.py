@@ -0,0 +1,381 @@
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional
+
+import requests
+
+from publish_journal import PublishJournal, PUBLISHED, FAILED
+from rate_limit import TokenBucket
+from vk_resolver import normalize_group_ref
+
+logger = logging.getLogger(__name__)
+
+# Лимиты площадок: (токенов в секунду, запас)
+# Telegram: не больше 20 сообщений в минуту в один чат/канал
+# VK: не больше 3 запросов в секунду на токен
+PLATFORM_LIMITS = {
+    "telegram": (20 / 60, 3),
+    "vk": (3, 3),
+}
+
+# Таймаут HTTP-запросов к площадкам: (соединение, ответ) в секундах
+REQUEST_TIMEOUT = (10, 60)
+
+# Сколько фото можно отправить одним сообщением (sendMediaGroup / вложения wall.post)
+MAX_GROUP_SIZE = 10
+
+QUEUED = "queued"
+SENDING = "sending"
+SENT = "sent"
+UNKNOWN = "unknown"
+
+
+class RetryAfter(Exception):
+    """Площадка просит повторить позже (Telegram 429 retry_after, VK flood control)"""
+    def __init__(self, seconds: float, message: str = ""):
+        super().__init__(message or f"повторить через {seconds} с")
+        self.seconds = seconds
+
+
+class DeliveryUnknown(Exception):
+    """Запрос публикации ушел, но ответа не дождались: пост мог выйти, повторять вслепую нельзя"""
+
+
+# ======================
+# --- Отправители ---
+# ======================
+
+class TelegramSender:
+    """Отправка в Telegram: текст, одно фото или альбом через sendMediaGroup"""
+    def __init__(self, bot_token: str, timeout=REQUEST_TIMEOUT):
+        self.base_url = f"https://api.telegram.org/bot{bot_token}/"
+        self.timeout = timeout
+
+    def _call(self, method: str, **kwargs) -> dict:
+        # Каждый вызов Telegram — сама публикация
+        try:
+            response = requests.post(self.base_url + method, timeout=self.timeout, **kwargs)
+        except requests.ReadTimeout as e:
+            raise DeliveryUnknown(f"{method}: нет ответа за {self.timeout[1]} с") from e
+        result = response.json()
+        if response.status_code == 429:
+            raise RetryAfter(result.get("parameters", {}).get("retry_after", 30), result.get("description", ""))
+        response.raise_for_status()
+        return result["result"]
+
+    def send(self, chat_id: str, jobs: List[dict]) -> dict:
+        payload = jobs[0]["payload"]
+        if jobs[0]["kind"] == "text":
+            result = self._call("sendMessage", json={
+                "chat_id": chat_id,
+                "text": payload["text"],
+                "parse_mode": "HTML",
+            })
+            return {"message_id": result["message_id"]}
+
+        if len(jobs) == 1:
+            with open(payload["path"], "rb") as photo:
+                result = self._call("sendPhoto", data={
+                    "chat_id": chat_id,
+                    "caption": payload["caption"],
+                    "parse_mode": "HTML",
+                }, files={"photo": photo})
+            return {"message_id": result["message_id"]}
+
+        # Альбом: подпись берется у первого фото
+        media, files = [], {}
+        try:
+            for i, job in enumerate(jobs):
+                item = {"type": "photo", "media": f"attach://photo{i}"}
+                if i == 0:
+                    item.update(caption=payload["caption"], parse_mode="HTML")
+                media.append(item)
+                files[f"photo{i}"] = open(job["payload"]["path"], "rb")
+            result = self._call("sendMediaGroup", data={
+                "chat_id": chat_id,
+                "media": json.dumps(media, ensure_ascii=False),
+            }, files=files)
+        finally:
+            for f in files.values():
+                f.close()
+        return {"message_id": result[0]["message_id"]}
+
+
+class VKSender:
+    """Отправка на стену VK: текст или пост с несколькими фото одним wall.post"""
+    # Коды ошибок VK: 6 — слишком много запросов в секунду, 9 — flood control
+    RETRY_CODES = {6: 1, 9: 60}
+
+    def __init__(self, access_token: str, api_version: str, timeout=REQUEST_TIMEOUT):
+        self.access_token = access_token
+        self.api_version = api_version
+        self.timeout = timeout
+
+    def _call(self, method: str, **params) -> dict:
+        params.update(access_token=self.access_token, v=self.api_version)
+        result = requests.post(f"https://api.vk.com/method/{method}", data=params, timeout=self.timeout).json()
+        if "error" in result:
+            code = result["error"].get("error_code")
+            if code in self.RETRY_CODES:
+                raise RetryAfter(self.RETRY_CODES[code], result["error"].get("error_msg", ""))
+            raise RuntimeError(f"VK API Error: {result['error']}")
+        return result["response"]
+
+    def upload_photo(self, group_id: str, path: str) -> str:
+        upload_url = self._call("photos.getWallUploadServer", group_id=group_id)["upload_url"]
+        with open(path, "rb") as img_file:
+            upload_resp = requests.post(upload_url, files={"photo": img_file}, timeout=self.timeout).json()
+        photo_info = self._call(
+            "photos.saveWallPhoto",
+            group_id=group_id,
+            photo=upload_resp["photo"],
+            server=upload_resp["server"],
+            hash=upload_resp["hash"],
+        )[0]
+        return f"photo{photo_info['owner_id']}_{photo_info['id']}"
+
+    def send(self, group_id: str, jobs: List[dict], on_uploaded: Callable[[dict], None] = None) -> dict:
+        group_id = normalize_group_ref(group_id)
+        params = {"owner_id": f"-{group_id}", "from_group": 1}
+        if jobs[0]["kind"] == "text":
+            params["message"] = jobs[0]["payload"]["text"]
+        else:
+            attachments = []
+            for job in jobs:
+                # Фото, загруженное прошлой попыткой, повторно не загружаем
+                if not job["payload"].get("attachment"):
+                    job["payload"]["attachment"] = self.upload_photo(group_id, job["payload"]["path"])
+                    if on_uploaded:
+                        on_uploaded(job)
+                attachments.append(job["payload"]["attachment"])
+            params["message"] = jobs[0]["payload"]["caption"]
+            params["attachments"] = ",".join(attachments)
+        # Зависшую загрузку фото можно повторить, а зависший wall.post — нет
+        try:
+            return {"post_id": self._call("wall.post", **params)["post_id"]}
+        except requests.ReadTimeout as e:
+            raise DeliveryUnknown(f"wall.post: нет ответа за {self.timeout[1]} с") from e
+
+
+# ======================
+# --- Очередь доставки ---
+# ======================
+
+class DeliveryQueue:
+    """
+    Надежная очередь исходящих публикаций на диске.
+    Для каждого направления — свой токен-бакет, фото одного слота
+    уходят одним сообщением, ошибки и 429 планируют повтор с задержкой.
+    """
+    def __init__(
+        self,
+        senders: Dict[str, object],
+        journal: Optional[PublishJournal] = None,
+        db_path: str = "data/delivery.db",
+        max_attempts: int = 5,
+    ):
+        self.senders = senders
+        self.journal = journal
+        self.db_path = db_path
+        self.max_attempts = max_attempts
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._drain_lock = threading.Lock()
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        with self._connect() as conn:
+            conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    destination TEXT NOT NULL,
+                    kind TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    group_key TEXT,
+                    journal_key TEXT,
+                    status TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    next_attempt_at REAL NOT NULL,
+                    last_error TEXT,
+                    created_at REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS idx_jobs_due ON jobs (status, next_attempt_at);
+                """
+            )
+            # Отправка, оборванная падением процесса, могла дойти — не повторяем вслепую
+            stuck = conn.execute("UPDATE jobs SET status = ? WHERE status = ?", (UNKNOWN, SENDING)).rowcount
+        if stuck:
+            logger.warning(f"{stuck} отправок прервано при прошлом запуске, результат неизвестен — проверьте вручную")
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        try:
+            yield conn
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _bucket(self, destination: str) -> TokenBucket:
+        if destination not in self._buckets:
+            rate, capacity = PLATFORM_LIMITS[destination.split(":", 1)[0]]
+            self._buckets[destination] = TokenBucket(rate, capacity)
+        return self._buckets[destination]
+
+    def enqueue(
+        self, destination: str, kind: str, payload: dict,
+        group_key: Optional[str] = None, journal_key: Optional[str] = None,
+    ) -> int:
+        """
+        Ставит публикацию в очередь. destination — «telegram:<chat_id>» или «vk:<group_id>»,
+        kind — «text» или «photo»; фото с одинаковым group_key уходят одним сообщением.
+        """
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "INSERT INTO jobs (destination, kind, payload, group_key, journal_key, status, next_attempt_at, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (destination, kind, json.dumps(payload, ensure_ascii=False), group_key, journal_key,
+                 QUEUED, time.time(), time.time()),
+            )
+            return cursor.lastrowid
+
+    def _due_jobs(self, conn) -> List[dict]:
+        rows = conn.execute(
+            "SELECT * FROM jobs WHERE status = ? AND next_attempt_at <= ? ORDER BY id",
+            (QUEUED, time.time()),
+        ).fetchall()
+        jobs = []
+        for row in rows:
+            job = dict(row)
+            job["payload"] = json.loads(job["payload"])
+            jobs.append(job)
+        return jobs
+
+    def _batches(self, jobs: List[dict]) -> List[List[dict]]:
+        """Текст уходит по одному, фото одного слота и направления — пачками до MAX_GROUP_SIZE"""
+        batches, groups = [], {}
+        for job in jobs:
+            if job["kind"] == "photo" and job["group_key"]:
+                key = (job["destination"], job["group_key"])
+                if key not in groups or len(groups[key]) >= MAX_GROUP_SIZE:
+                    groups[key] = []
+                    batches.append(groups[key])
+                groups[key].append(job)
+            else:
+                batches.append([job])
+        return batches
+
+    def _update(self, jobs: List[dict], **fields):
+        assignments = ", ".join(f"{name} = ?" for name in fields)
+        with self._connect() as conn:
+            for job in jobs:
+                conn.execute(f"UPDATE jobs SET {assignments} WHERE id = ?", (*fields.values(), job["id"]))
+
+    def _record_journal(self, jobs: List[dict], state: str, **data):
+        if not self.journal:
+            return
+        for job in jobs:
+            if job["journal_key"]:
+                self.journal.record(job["journal_key"], job["destination"], state, **data)
+
+    def drain(self, wait: bool = True) -> int:
+        """
+        Отправляет все готовые задания, не дожидаясь токенов: направление
+        без свободных токенов пропускается до следующего прохода.
+        wait=False — если очередь уже разбирает другой поток, сразу выходит.
+        Возвращает количество отправленных заданий.
+        """
+        if not self._drain_lock.acquire(blocking=wait):
+            return 0
+        try:
+            with self._connect() as conn:
+                jobs = self._due_jobs(conn)
+
+            sent = 0
+            throttled = set()
+            for batch in self._batches(jobs):
+                destination = batch[0]["destination"]
+                if destination in throttled or not self._bucket(destination).try_acquire():
+                    throttled.add(destination)
+                    continue
+                sent += self._send(batch)
+            return sent
+        finally:
+            self._drain_lock.release()
+
+    def has_job(self, journal_key: str, destination: str) -> bool:
+        """Есть ли для слота и направления задание, которое еще отправляется или уже отправлено"""
+        with self._connect() as conn:
+            return conn.execute(
+                "SELECT 1 FROM jobs WHERE journal_key = ? AND destination = ? AND status != ? LIMIT 1",
+                (journal_key, destination, FAILED),
+            ).fetchone() is not None
+
+    def pending(self) -> int:
+        """Сколько заданий ждет отправки, включая отложенные повторы"""
+        with self._connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM jobs WHERE status = ?", (QUEUED,)).fetchone()[0]
+
+    def _send(self, batch: List[dict]) -> int:
+        destination = batch[0]["destination"]
+        platform, target = destination.split(":", 1)
+        self._update(batch, status=SENDING, attempts=batch[0]["attempts"] + 1)
+
+        def on_uploaded(job):
+            self._update([job], payload=json.dumps(job["payload"], ensure_ascii=False))
+
+        try:
+            sender = self.senders[platform]
+            if platform == "vk":
+                result = sender.send(target, batch, on_uploaded)
+            else:
+                result = sender.send(target, batch)
+        except RetryAfter as e:
+            self._bucket(destination).penalize(e.seconds)
+            self._update(batch, status=QUEUED, next_attempt_at=time.time() + e.seconds, last_error=str(e))
+            logger.warning(f"{destination}: лимит площадки, повтор через {e.seconds} с")
+            return 0
+        except DeliveryUnknown as e:
+            # Журнал остается в «queued»: слот считается обработанным и не публикуется повторно
+            self._update(batch, status=UNKNOWN, last_error=str(e))
+            logger.warning(f"{destination}: {e}, результат неизвестен — проверьте вручную")
+            return 0
+        except Exception as e:
+            attempts = batch[0]["attempts"] + 1
+            if attempts >= self.max_attempts:
+                self._update(batch, status=FAILED, last_error=str(e))
+                self._record_journal(batch, FAILED, error=str(e))
+                logger.error(f"{destination}: публикация не удалась после {attempts} попыток: {e}")
+                self._release_files(batch)
+            else:
+                delay = 30 * 2 ** (attempts - 1)
+                self._update(batch, status=QUEUED, next_attempt_at=time.time() + delay, last_error=str(e))
+                logger.warning(f"{destination}: ошибка публикации, повтор через {delay} с: {e}")
+            return 0
+
+        self._update(batch, status=SENT, last_error=None)
+        self._record_journal(batch, PUBLISHED, **result)
+        logger.info(f"Опубликовано в {destination}: {result}")
+        self._release_files(batch)
+        return len(batch)
+
+    def _release_files(self, batch: List[dict]):
+        """
+        Удаляет картинку слота, когда все отправки с ней завершились (sent или failed).
+        Отправка в неизвестном состоянии файл держит: он нужен для ручной проверки.
+        """
+        paths = {job["payload"].get("path") for job in batch if job["kind"] == "photo"} - {None}
+        for path in paths:
+            with self._connect() as conn:
+                pending = conn.execute(
+                    "SELECT 1 FROM jobs WHERE kind = 'photo' AND status NOT IN (?, ?) "
+                    "AND json_extract(payload, '$.path') = ? LIMIT 1",
+                    (SENT, FAILED, path),
+                ).fetchone()
+            if not pending and os.path.exists(path):
+                os.remove(path)
+                logger.info(f"Картинка {path} отправлена во все направления, файл удален")
@@ -0,0 +1,100 @@
+import os
+import time
+import sqlite3
+import logging
+from contextlib import contextmanager
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+class DraftPool:
+    """
+    Запас готовых черновиков по группам.
+    Кандидаты, проигравшие выбор best-of-N, сохраняются сюда, и следующие
+    слоты публикуют их без запроса к Gemini. Старые черновики не берутся:
+    в них может быть устаревший контекст (время суток, погода, праздник).
+    Черновик выдается только слоту с тем же контекстом времени, под который он написан.
+    """
+    def __init__(self, db_path: str = "data/draft_pool.db", max_age_hours: float = 24):
+        self.db_path = db_path
+        self.max_age = max_age_hours * 3600
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        with self._connect() as conn:
+            conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS drafts (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    tenant TEXT NOT NULL,
+                    topic TEXT NOT NULL,
+                    time_context TEXT,
+                    text TEXT NOT NULL,
+                    rank REAL NOT NULL,
+                    created_at INTEGER NOT NULL,
+                    used_at INTEGER
+                );
+                CREATE INDEX IF NOT EXISTS drafts_unused ON drafts (tenant, used_at, created_at);
+                """
+            )
+            # Базы до появления контекста времени: старые черновики без него не выдаются
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(drafts)")]
+            if "time_context" not in columns:
+                conn.execute("ALTER TABLE drafts ADD COLUMN time_context TEXT")
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            yield conn
+            conn.commit()
+        finally:
+            conn.close()
+
+    def add(self, tenant: str, topic: str, time_context: str, text: str, rank: float):
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO drafts (tenant, topic, time_context, text, rank, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (tenant, topic, time_context, text, rank, int(time.time())),
+            )
+
+    def available(self, tenant: str, time_context: str, topic: str) -> int:
+        """Сколько свежих неиспользованных черновиков с этой темой и контекстом времени"""
+        fresh_since = int(time.time() - self.max_age)
+        with self._connect() as conn:
+            return conn.execute(
+                """
+                SELECT COUNT(*) FROM drafts
+                WHERE tenant = ? AND time_context = ? AND topic = ? AND used_at IS NULL AND created_at >= ?
+                """,
+                (tenant, time_context, topic, fresh_since),
+            ).fetchone()[0]
+
+    def take(self, tenant: str, time_context: str, topic: Optional[str] = None, same_topic: bool = False) -> Optional[dict]:
+        """
+        Забирает лучший свежий черновик группы, написанный под тот же time_context,
+        предпочитая ту же тему; same_topic=True — только с темой topic (слоты плана).
+        Черновик помечается использованным и второй раз не выдается.
+        """
+        fresh_since = int(time.time() - self.max_age)
+        topic_filter = "AND topic = ?" if same_topic else ""
+        params = (tenant, time_context, fresh_since) + ((topic,) if same_topic else ()) + (topic,)
+        with self._connect() as conn:
+            while True:
+                row = conn.execute(
+                    f"""
+                    SELECT id, topic, text FROM drafts
+                    WHERE tenant = ? AND time_context = ? AND used_at IS NULL AND created_at >= ? {topic_filter}
+                    ORDER BY topic = ? DESC, rank DESC LIMIT 1
+                    """,
+                    params,
+                ).fetchone()
+                if not row:
+                    return None
+                # Другой цикл мог забрать тот же черновик — тогда берем следующий
+                taken = conn.execute(
+                    "UPDATE drafts SET used_at = ? WHERE id = ? AND used_at IS NULL",
+                    (int(time.time()), row[0]),
+                ).rowcount
+                conn.commit()
+                if taken:
+                    return {"id": row[0], "topic": row[1], "text": row[2]}
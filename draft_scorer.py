@@ -0,0 +1,190 @@
+import re
+import logging
+from dataclasses import dataclass, field
+from statistics import median
+from typing import Iterable, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Фразы, с которыми пост не публикуется ни при каких условиях (ищутся целыми словами)
+DEFAULT_BANNED_PHRASES = [
+    "как языковая модель",
+    "как ИИ",
+    "Вот пост",
+    "Вот ваш пост",
+    "Конечно! Вот",
+]
+
+WORD_RE = re.compile(r"[а-яёa-z]+", re.IGNORECASE)
+LENGTH_RE = re.compile(r"(\d+)\s*[-–—]\s*(\d+)\s*символ")
+
+
+def target_length(system_prompt: str, default: Tuple[int, int] = (400, 1200)) -> Tuple[int, int]:
+    """Целевой объем поста из промпта персонажа («Объем — 400-500 символов»)"""
+    match = LENGTH_RE.search(system_prompt or "")
+    if not match:
+        return default
+    return int(match.group(1)), int(match.group(2))
+
+
+def _words(text: str) -> List[str]:
+    return [w.lower() for w in WORD_RE.findall(text)]
+
+
+def _jaccard(a: Set[str], b: Set[str]) -> float:
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+@dataclass
+class DraftScore:
+    score: float
+    # Мягкие проблемы: черновик стоит перегенерировать, но в крайнем случае можно публиковать
+    issues: List[str] = field(default_factory=list)
+    # Жесткие проблемы: публиковать нельзя
+    rejections: List[str] = field(default_factory=list)
+    predicted_engagement: Optional[float] = None
+    # Насколько пост не похож на прошлые: 1 — ничего общего, 0 — повтор
+    novelty: Optional[float] = None
+    # Ключ выбора лучшего из нескольких кандидатов
+    rank: float = 0.0
+
+    @property
+    def passed(self) -> bool:
+        return not self.issues and not self.rejections
+
+    @property
+    def publishable(self) -> bool:
+        return not self.rejections
+
+    def feedback(self) -> str:
+        """Замечания для следующей попытки генерации"""
+        return "; ".join(self.rejections + self.issues)
+
+
+class DraftScorer:
+    """
+    Быстрая локальная проверка черновика без обращений к LLM:
+    объем, язык, повторы, запрещенные фразы и прогноз вовлеченности по истории.
+    """
+    def __init__(
+        self,
+        system_prompt: str,
+        banned_phrases: Iterable[str] = DEFAULT_BANNED_PHRASES,
+        allow_questions: bool = True,
+        length_tolerance: float = 0.2,
+        min_cyrillic_share: float = 0.8,
+        max_repeated_trigrams: float = 0.1,
+        min_engagement_ratio: float = 0.5,
+        min_history: int = 10,
+        max_similarity: float = 0.5,
+        novelty_weight: float = 0.3,
+        engagement_weight: float = 0.2,
+    ):
+        low, high = target_length(system_prompt)
+        self.min_length = int(low * (1 - length_tolerance))
+        self.max_length = int(high * (1 + length_tolerance))
+        # «вот пост» не должно ловить «Вот постепенно…»
+        self.banned_phrases = [
+            (phrase, re.compile(rf"\b{re.escape(phrase)}\b", re.IGNORECASE)) for phrase in banned_phrases
+        ]
+        self.allow_questions = allow_questions
+        self.min_cyrillic_share = min_cyrillic_share
+        self.max_repeated_trigrams = max_repeated_trigrams
+        self.min_engagement_ratio = min_engagement_ratio
+        self.min_history = min_history
+        self.max_similarity = max_similarity
+        self.novelty_weight = novelty_weight
+        self.engagement_weight = engagement_weight
+
+    def score(self, text: str, history: Optional[List[dict]] = None) -> DraftScore:
+        """Оценивает черновик. history — прошлые посты VK с метриками"""
+        text = (text or "").strip()
+        result = DraftScore(score=1.0)
+
+        for phrase, pattern in self.banned_phrases:
+            if pattern.search(text):
+                result.rejections.append(f"запрещенная фраза «{phrase}»")
+
+        letters = [c for c in text if c.isalpha()]
+        cyrillic = sum(1 for c in letters if "а" <= c.lower() <= "я" or c in "ёЁ")
+        if not letters or cyrillic / len(letters) < self.min_cyrillic_share:
+            result.rejections.append("текст не на русском")
+
+        length = len(text)
+        if not self.min_length <= length <= self.max_length:
+            result.issues.append(f"объем {length} символов вместо {self.min_length}-{self.max_length}")
+            result.score -= 0.3
+
+        words = _words(text)
+        trigrams = list(zip(words, words[1:], words[2:]))
+        if trigrams:
+            repeated = 1 - len(set(trigrams)) / len(trigrams)
+            if repeated > self.max_repeated_trigrams:
+                result.issues.append(f"много повторов ({repeated:.0%} повторяющихся фраз)")
+                result.score -= 0.3
+
+        if not self.allow_questions and "?" in text:
+            result.issues.append("вопросы к читателю")
+            result.score -= 0.1
+
+        baseline = None
+        if history:
+            result.predicted_engagement, baseline = self._predict_engagement(set(words), history)
+            if baseline and result.predicted_engagement < baseline * self.min_engagement_ratio:
+                result.issues.append("низкая ожидаемая вовлеченность")
+                result.score -= 0.2
+
+            similarity = max((_jaccard(set(words), set(_words(p["text"]))) for p in history if p.get("text")), default=0.0)
+            result.novelty = 1 - similarity
+            if similarity > self.max_similarity:
+                result.issues.append("повторяет недавний пост")
+                result.score -= 0.2
+
+        if result.rejections:
+            result.score = 0.0
+        result.score = max(result.score, 0.0)
+
+        result.rank = result.score
+        if result.novelty is not None:
+            result.rank += self.novelty_weight * result.novelty
+        if baseline:
+            ratio = min(result.predicted_engagement / baseline, 2.0)
+            result.rank += self.engagement_weight * (ratio - 1)
+        return result
+
+    def rank(self, texts: List[str], history: Optional[List[dict]] = None) -> List[Tuple[str, DraftScore]]:
+        """
+        Оценивает несколько кандидатов и сортирует от лучшего:
+        сначала публикуемые, затем по качеству, новизне и прогнозу вовлеченности.
+        """
+        scored = [(text, self.score(text, history)) for text in texts]
+        return sorted(scored, key=lambda item: (item[1].publishable, item[1].rank), reverse=True)
+
+    def similar(self, a: str, b: str) -> bool:
+        """Два черновика почти об одном и том же"""
+        return _jaccard(set(_words(a)), set(_words(b))) > self.max_similarity
+
+    def _predict_engagement(self, words: Set[str], history: List[dict]) -> Tuple[Optional[float], Optional[float]]:
+        """
+        Вовлеченность похожих прошлых постов (лайки и репосты на просмотр),
+        взвешенная по пересечению слов. Возвращает (прогноз, медиана по истории).
+        """
+        rates = []
+        for p in history:
+            views = p.get("views", {}).get("count", 0)
+            if not views or not p.get("text"):
+                continue
+            rate = (p["likes"]["count"] + 2 * p["reposts"]["count"]) / views
+            rates.append((_jaccard(words, set(_words(p["text"]))), rate))
+
+        if len(rates) < self.min_history:
+            return None, None
+
+        baseline = median(rate for _, rate in rates)
+        nearest = sorted(rates, reverse=True)[:5]
+        weight = sum(sim for sim, _ in nearest)
+        if not weight:
+            return baseline, baseline
+        return sum(sim * rate for sim, rate in nearest) / weight, baseline
@@ -0,0 +1,199 @@
+import os
+import json
+import time
+import base64
+import hashlib
+import logging
+import threading
+from types import SimpleNamespace
+from typing import Any, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class FixtureMissing(Exception):
+    """Для вызова нет ни записанного ответа, ни записи того же метода"""
+
+
+class Fixtures:
+    """
+    Записанные ответы внешних API: <path>/<service>/<method>/<hash параметров>.json.
+    record=True — вызов идет в сеть, ответ сохраняется; иначе ответ берется из записи.
+    Если точной записи нет (в промпте другое время, другой offset), отдается
+    по кругу любая запись того же метода — для нагрузочного прогона этого достаточно.
+    """
+    def __init__(self, path: str = "data/fixtures", record: bool = False):
+        self.path = path
+        self.record = record
+        self._lock = threading.Lock()
+        self._fallbacks: Dict[str, int] = {}
+
+    def _dir(self, service: str, method: str) -> str:
+        return os.path.join(self.path, service, method)
+
+    def call(self, service: str, method: str, params: dict, live: Callable[[], Any]) -> Any:
+        digest = hashlib.sha1(json.dumps(params, sort_keys=True, default=str).encode("utf-8")).hexdigest()[:16]
+        path = os.path.join(self._dir(service, method), f"{digest}.json")
+
+        if self.record:
+            value = live()
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump({"params": params, "response": value}, f, ensure_ascii=False, indent=2, default=str)
+            return value
+
+        if not os.path.exists(path):
+            path = self._fallback(service, method)
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)["response"]
+
+    def _fallback(self, service: str, method: str) -> str:
+        directory = self._dir(service, method)
+        names = sorted(os.listdir(directory)) if os.path.isdir(directory) else []
+        if not names:
+            raise FixtureMissing(f"нет записанных ответов {service}.{method}, запустите пробный прогон с --record")
+        with self._lock:
+            index = self._fallbacks.get(directory, 0)
+            self._fallbacks[directory] = index + 1
+        return os.path.join(directory, names[index % len(names)])
+
+
+class _VKMethod:
+    def __init__(self, api, fixtures: Fixtures, section: str):
+        self._api = api
+        self._fixtures = fixtures
+        self._section = section
+
+    def __getattr__(self, name: str):
+        method = f"{self._section}.{name}"
+
+        def call(**params):
+            live = lambda: getattr(getattr(self._api, self._section), name)(**params)
+            return self._fixtures.call("vk", method, params, live)
+        return call
+
+
+class RecordedVKAPI:
+    """vk.API, отвечающий из фикстур: api.wall.get(...), api.groups.getById(...)"""
+    def __init__(self, api, fixtures: Fixtures):
+        self._api = api
+        self._fixtures = fixtures
+
+    def __getattr__(self, section: str) -> _VKMethod:
+        return _VKMethod(self._api, self._fixtures, section)
+
+
+def _dump_candidates(response) -> List[List[dict]]:
+    """Ответ Gemini в JSON: кандидаты → части (текст или картинка в base64)"""
+    candidates = []
+    for candidate in response.candidates:
+        parts = []
+        for part in candidate.content.parts:
+            if getattr(part, "text", None):
+                parts.append({"text": part.text})
+            elif getattr(part, "inline_data", None) is not None:
+                parts.append({"image": base64.b64encode(part.inline_data.data).decode("ascii")})
+        candidates.append(parts)
+    return candidates
+
+
+def _load_response(candidates: List[List[dict]]) -> SimpleNamespace:
+    """Объект с тем же интерфейсом, что ответ Gemini: .text и .candidates[].content.parts[]"""
+    loaded = []
+    for parts in candidates:
+        loaded.append(SimpleNamespace(content=SimpleNamespace(parts=[
+            SimpleNamespace(
+                text=part.get("text"),
+                inline_data=SimpleNamespace(data=base64.b64decode(part["image"])) if "image" in part else None,
+            )
+            for part in parts
+        ])))
+    text = next((part["text"] for parts in candidates for part in parts if "text" in part), "")
+    return SimpleNamespace(candidates=loaded, text=text)
+
+
+class RecordedModel:
+    """
+    GenerativeModel, отвечающий из фикстур.
+    method — папка записей вызывающего (recommend, digest, generate_post): у каждого
+    свой формат ответа, и запасной ответ не должен приходить от чужого промпта.
+    """
+    def __init__(self, model, fixtures: Fixtures, method: str):
+        self._model = model
+        self._fixtures = fixtures
+        self._method = method
+
+    def generate_content(self, prompt: str, generation_config: Optional[dict] = None):
+        params = {"prompt": prompt, "generation_config": generation_config}
+
+        def live():
+            if generation_config is None:
+                return _dump_candidates(self._model.generate_content(prompt))
+            return _dump_candidates(self._model.generate_content(prompt, generation_config=generation_config))
+        return _load_response(self._fixtures.call("gemini", self._method, params, live))
+
+
+class RecordedImageClient:
+    """genai.Client для картинок, отвечающий из фикстур: client.models.generate_content(...)"""
+    def __init__(self, client_factory: Callable[[], Any], fixtures: Fixtures):
+        self._client_factory = client_factory
+        self._fixtures = fixtures
+        self.models = self
+
+    def generate_content(self, model: str, contents: str, config=None):
+        # config SDK не сериализуется; для картинок он всегда один и тот же
+        params = {"model": model, "contents": contents}
+
+        def live():
+            client = self._client_factory()
+            return _dump_candidates(client.models.generate_content(model=model, contents=contents, config=config))
+        return _load_response(self._fixtures.call("gemini", "generate_image", params, live))
+
+
+class RecordingSender:
+    """
+    Отправитель площадки, который ничего не публикует, а записывает,
+    что, куда и когда ушло бы, и сколько задание простояло в очереди.
+    latency — имитация времени ответа площадки.
+    """
+    def __init__(self, platform: str, latency: float = 0.0, log_path: str = "data/sent.jsonl"):
+        self.platform = platform
+        self.latency = latency
+        self.log_path = log_path
+        self.sent: List[dict] = []
+        self._lock = threading.Lock()
+
+    def send(self, target: str, jobs: List[dict], on_uploaded: Callable[[dict], None] = None) -> dict:
+        if self.latency:
+            time.sleep(self.latency)
+        now = time.time()
+        record = {
+            "platform": self.platform,
+            "target": target,
+            "at": now,
+            "queued_seconds": round(now - min(job["created_at"] for job in jobs), 3),
+            "jobs": [{"kind": job["kind"], "journal_key": job["journal_key"], "payload": job["payload"]} for job in jobs],
+        }
+        with self._lock:
+            self.sent.append(record)
+            number = len(self.sent)
+            os.makedirs(os.path.dirname(self.log_path) or ".", exist_ok=True)
+            with open(self.log_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        logger.info(f"[dry-run] {self.platform}:{target}: {len(jobs)} заданий ({jobs[0]['kind']}) записано вместо отправки")
+        if self.platform == "vk":
+            return {"post_id": number}
+        return {"message_id": number}
+
+
+def write_report(path: str, cycles: List[dict], senders: Dict[str, RecordingSender], elapsed: float) -> dict:
+    """Отчет пробного прогона: этапы и тайминги каждого цикла и все перехваченные отправки"""
+    report = {
+        "elapsed": round(elapsed, 3),
+        "cycles": cycles,
+        "sent": [record for sender in senders.values() for record in sender.sent],
+    }
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    return report
@@ -0,0 +1,80 @@
+import asyncio
+import logging
+from datetime import datetime
+from typing import Awaitable, Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class CycleDeadlineExceeded(Exception):
+    """Цикл публикации не успел до следующего слота"""
+
+
+class Deadline:
+    """
+    Срок, до которого цикл должен завершиться.
+    Конвейер отменяет ожидание этапов по истечении срока; блокирующий вызов
+    внутри потока доработает, но его результат уже не будет опубликован.
+    """
+    def __init__(self, at: Optional[datetime] = None):
+        self.at = at
+
+    def remaining(self) -> Optional[float]:
+        if self.at is None:
+            return None
+        return (self.at - datetime.now(self.at.tzinfo)).total_seconds()
+
+    def expired(self) -> bool:
+        remaining = self.remaining()
+        return remaining is not None and remaining <= 0
+
+    def check(self, stage: str):
+        if self.expired():
+            raise CycleDeadlineExceeded(f"срок {self.at} истек перед этапом «{stage}»")
+
+
+class JobGuard:
+    """
+    Модель конкурентности для циклов публикации в одном event loop:
+    - один цикл на группу (tenant) одновременно, перекрывающийся запуск пропускается;
+    - общий лимит одновременно работающих циклов;
+    - запуск, не дождавшийся свободного места до своего срока, пропускается.
+    """
+    def __init__(self, max_workers: int = 4):
+        self.max_workers = max_workers
+        self._slots = asyncio.Semaphore(max_workers)
+        self._tenant_locks: Dict[str, asyncio.Lock] = {}
+
+    async def run(
+        self, tenant: str, func: Callable[[Deadline], Awaitable[object]], deadline: Optional[datetime] = None
+    ) -> bool:
+        """Запускает func(deadline) с учетом ограничений. Возвращает True, если цикл отработал"""
+        lock = self._tenant_locks.setdefault(tenant, asyncio.Lock())
+        if lock.locked():
+            logger.warning(f"[{tenant}] Предыдущий цикл еще выполняется, пропускаю запуск")
+            return False
+        async with lock:
+            cycle_deadline = Deadline(deadline)
+            remaining = cycle_deadline.remaining()
+            try:
+                await asyncio.wait_for(self._slots.acquire(), max(remaining, 0) if remaining is not None else None)
+            except asyncio.TimeoutError:
+                logger.warning(f"[{tenant}] Все {self.max_workers} воркеров заняты до следующего слота, пропускаю запуск")
+                return False
+            try:
+                await func(cycle_deadline)
+                return True
+            except CycleDeadlineExceeded as e:
+                logger.warning(f"[{tenant}] Цикл прерван: {e}")
+                return False
+            finally:
+                self._slots.release()
+
+
+def next_slot(scheduler, tenant: str) -> Optional[datetime]:
+    """Ближайший следующий запуск любой задачи группы — срок для текущего цикла"""
+    times = [
+        job.next_run_time for job in scheduler.get_jobs()
+        if job.id.startswith(f"{tenant}:") and job.next_run_time
+    ]
+    return min(times) if times else None
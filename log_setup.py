@@ -0,0 +1,144 @@
+import re
+import json
+import time
+import queue
+import atexit
+import logging
+import threading
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler, TimedRotatingFileHandler
+from typing import Dict, Optional, Tuple
+
+NUMBER_RE = re.compile(r"\d+(?:\.\d+)?")
+
+
+class RepeatFilter(logging.Filter):
+    """
+    Гасит повторы одной и той же ошибки: запись из того же места кода, с тем же
+    исключением и тем же текстом без учета чисел (id, задержки, счетчики) проходит
+    раз в window секунд, следующая после паузы сообщает, сколько повторов пропущено.
+    Во время сбоя (429, недоступный VK) лог не забивается одинаковыми трейсбеками.
+    """
+    def __init__(self, window: float = 300, min_level: int = logging.WARNING, max_keys: int = 1000):
+        super().__init__()
+        self.window = window
+        self.min_level = min_level
+        self.max_keys = max_keys
+        self._seen: Dict[Tuple, list] = {}
+        self._lock = threading.Lock()
+
+    def _key(self, record: logging.LogRecord) -> Tuple:
+        exc_type = exc_site = None
+        if record.exc_info and record.exc_info[0]:
+            exc_type = record.exc_info[0].__name__
+            tb = record.exc_info[2]
+            while tb and tb.tb_next:
+                tb = tb.tb_next
+            if tb:
+                exc_site = (tb.tb_frame.f_code.co_filename, tb.tb_lineno)
+        message = NUMBER_RE.sub("N", record.getMessage())
+        return record.name, record.levelno, record.pathname, record.lineno, exc_type, exc_site, message
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self.window <= 0 or record.levelno < self.min_level:
+            return True
+        key = self._key(record)
+        now = time.monotonic()
+        with self._lock:
+            seen = self._seen.get(key)
+            if seen and now - seen[0] < self.window:
+                seen[1] += 1
+                return False
+            if len(self._seen) >= self.max_keys:
+                self._seen = {k: v for k, v in self._seen.items() if now - v[0] < self.window}
+            self._seen[key] = [now, 0]
+        if seen and seen[1]:
+            record.repeats = seen[1]
+            record.msg = f"{record.getMessage()} (повторилось еще {seen[1]} раз за {now - seen[0]:.0f} с)"
+            record.args = None
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна запись — одна строка JSON"""
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "message": record.getMessage(),
+        }
+        if getattr(record, "repeats", None):
+            entry["repeats"] = record.repeats
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class BoundedQueueHandler(QueueHandler):
+    """
+    Кладет запись в ограниченную очередь и сразу возвращается: запись на диск
+    делает поток QueueListener. Трейсбек форматируется там же, а не в вызывающем потоке.
+    Если очередь переполнена, запись отбрасывается, а число потерь попадает в лог позже.
+    """
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Очередь внутри процесса: запись не сериализуется, достаточно зафиксировать текст
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            if self.dropped:
+                dropped, self.dropped = self.dropped, 0
+                self.queue.put_nowait(logging.makeLogRecord({
+                    "name": __name__, "levelno": logging.WARNING, "levelname": "WARNING",
+                    "msg": f"Очередь логов была переполнена, потеряно записей: {dropped}",
+                }))
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def setup_logging(
+    path: str,
+    fmt: str,
+    level: int = logging.INFO,
+    max_bytes: int = 5 * 1024 * 1024,
+    backup_count: int = 5,
+    rotate_when: Optional[str] = None,
+    json_format: bool = False,
+    dedup_seconds: float = 300,
+    queue_size: int = 10000,
+) -> None:
+    """
+    Логирование через очередь: вызывающий поток только кладет запись в очередь,
+    файл и консоль пишет отдельный поток. Файл ротируется по размеру
+    (или по времени, если задан rotate_when, например 'midnight'), хранится backup_count архивов.
+    """
+    formatter = JsonFormatter() if json_format else logging.Formatter(fmt)
+    if rotate_when:
+        file_handler = TimedRotatingFileHandler(path, when=rotate_when, backupCount=backup_count, encoding="utf-8")
+    else:
+        file_handler = RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8")
+    stream_handler = logging.StreamHandler()
+    for handler in (file_handler, stream_handler):
+        handler.setFormatter(formatter)
+
+    queue_handler = BoundedQueueHandler(queue.Queue(queue_size))
+    # Повторы отсекаются до очереди и не занимают в ней места
+    queue_handler.addFilter(RepeatFilter(dedup_seconds))
+
+    root = logging.getLogger()
+    root.handlers = [queue_handler]
+    root.setLevel(level)
+
+    listener = QueueListener(queue_handler.queue, file_handler, stream_handler, respect_handler_level=True)
+    listener.start()
+    # При выходе дописывает остаток очереди
+    atexit.register(listener.stop)
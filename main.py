@@ -10,18 +10,28 @@ import logging
 import google.generativeai as genai
 from dotenv import load_dotenv
 
+from adaptive_frequency import PostingController, ADVANCE, DELAY, SKIP
+from draft_scorer import DraftScorer
+from log_setup import setup_logging
+from metrics_refresh import MetricsRefresher, fetch_new_posts
+from vk_resolver import GroupResolver
+
 # Load environment variables from .env file
 load_dotenv()
 
 # Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('village_blogger.log'),
-        logging.StreamHandler()
-    ]
-)
+def configure_logging():
+    """Логирование настраивается при запуске, а не при импорте модуля"""
+    setup_logging(
+        'village_blogger.log',
+        '%(asctime)s - %(levelname)s - %(message)s',
+        max_bytes=int(os.getenv('LOG_MAX_BYTES', str(5 * 1024 * 1024))),
+        backup_count=int(os.getenv('LOG_BACKUP_COUNT', '5')),
+        rotate_when=os.getenv('LOG_ROTATE_WHEN') or None,
+        json_format=os.getenv('LOG_JSON', '0') == '1',
+        dedup_seconds=float(os.getenv('LOG_DEDUP_SECONDS', '300')),
+    )
+
 logger = logging.getLogger(__name__)
 
 class VillageContentGenerator:
@@ -69,8 +79,8 @@ class VillageContentGenerator:
         Длина поста: 800-1200 символов.
         """
     
-    def generate_post(self, topic: str, season: str = None) -> str:
-        """Генерирует пост на заданную тему"""
+    def generate_post(self, topic: str, season: str = None, feedback: str = None) -> str:
+        """Генерирует пост на заданную тему. feedback — замечания к прошлому варианту"""
         if not self.model:
             logger.warning("Gemini API недоступен, используем резервный пост")
             return self._get_fallback_post(topic)
@@ -85,6 +95,8 @@ class VillageContentGenerator:
         
         Сделай пост живым, с конкретными деталями и личной историей.
         """
+        if feedback:
+            prompt += f"\nПрошлый вариант отклонен: {feedback}. Исправь это."
         
         try:
             response = self.model.generate_content(prompt)
@@ -143,16 +155,20 @@ class VKPoster:
             raise ValueError("VK access token и group ID обязательны")
             
         self.access_token = access_token
-        self.group_id = group_id.replace('-', '')  # Убираем минус если есть
         self.api_version = '5.131'
         self.base_url = 'https://api.vk.com/method/'
+
+        # GROUP_ID можно задать как '-123', '123' или короткое имя; id берется из общего кеша групп
+        self.groups = GroupResolver(self.get_groups)
+        self.group_id = str(self.groups.group_id(group_id))
+        self.owner_id = -int(self.group_id)
     
     def post_to_wall(self, message: str, attachments: str = None) -> bool:
         """Публикует пост на стену сообщества"""
         url = f"{self.base_url}wall.post"
         
         params = {
-            'owner_id': f'-{self.group_id}',
+            'owner_id': self.owner_id,
             'message': message,
             'from_group': 1,
             'access_token': self.access_token,
@@ -177,13 +193,14 @@ class VKPoster:
             logger.error(f"Ошибка публикации поста: {e}")
             return False
     
-    def get_wall_posts(self, count: int = 10) -> List[Dict]:
+    def get_wall_posts(self, count: int = 10, offset: int = 0) -> List[Dict]:
         """Получает последние посты со стены"""
         url = f"{self.base_url}wall.get"
         
         params = {
-            'owner_id': f'-{self.group_id}',
+            'owner_id': self.owner_id,
             'count': count,
+            'offset': offset,
             'access_token': self.access_token,
             'v': self.api_version
         }
@@ -202,12 +219,52 @@ class VKPoster:
             logger.error(f"Ошибка получения постов: {e}")
             return []
 
+    def get_posts_by_id(self, post_ids: List[str]) -> List[Dict]:
+        """Получает посты по идентификаторам вида '<owner_id>_<post_id>'"""
+        url = f"{self.base_url}wall.getById"
+
+        params = {
+            'posts': ','.join(post_ids),
+            'access_token': self.access_token,
+            'v': self.api_version
+        }
+
+        response = requests.post(url, params=params)
+        result = response.json()
+
+        if 'error' in result:
+            raise RuntimeError(f"VK API Error: {result['error']}")
+
+        return result['response']
+
+    def get_groups(self, group_ids: List[str]) -> List[Dict]:
+        """Метаданные групп (id, название, число подписчиков)"""
+        url = f"{self.base_url}groups.getById"
+
+        params = {
+            'group_ids': ','.join(group_ids),
+            'fields': 'members_count',
+            'access_token': self.access_token,
+            'v': self.api_version
+        }
+
+        response = requests.post(url, params=params)
+        result = response.json()
+
+        if 'error' in result:
+            raise RuntimeError(f"VK API Error: {result['error']}")
+
+        return result['response']
+
 class VillageBloggerAgent:
     """Главный класс агента-блоггера"""
     
     def __init__(self, vk_token: str, group_id: str, gemini_api_key: str):
         self.vk_poster = VKPoster(vk_token, group_id)
+        self.metrics = MetricsRefresher()
         self.content_generator = VillageContentGenerator(gemini_api_key)
+        self.scorer = DraftScorer(getattr(self.content_generator, 'system_prompt', ''))
+        self.draft_retry_budget = 2  # Сколько раз можно перегенерировать неудачный пост
         
         # Популярные темы с весами для случайного выбора
         self.topics = {
@@ -225,14 +282,32 @@ class VillageBloggerAgent:
         
         self.last_post_time = None
         self.min_interval_hours = 4  # Минимальный интервал между постами
+        self.delayed_until = None  # Слот, сдвинутый из-за слабой реакции аудитории
+        self.advanced_slot = None  # (дата, час) слота, опубликованного досрочно
+
+        # Частота подстраивается под реакцию на последний пост
+        self.controller = PostingController(
+            self.metrics,
+            owner_id=self.vk_poster.owner_id,
+            poll_latest=lambda: self.vk_poster.get_wall_posts(count=2),
+            min_gap_hours=self.min_interval_hours,
+        )
         
     def should_post_now(self) -> bool:
         """Определяет, нужно ли публиковать пост сейчас"""
         current_time = datetime.datetime.now()
         current_hour = current_time.hour
-        
-        # Проверяем, что сейчас подходящее время для поста
-        if current_hour not in self.posting_hours:
+
+        # Сдвинутый слот публикуем, как только подошло время; до тех пор новых решений не принимаем
+        if self.delayed_until:
+            if current_time >= self.delayed_until:
+                self.delayed_until = None
+                return True
+            return False
+
+        # Этот слот уже опубликован досрочно
+        if self.advanced_slot == (current_time.date(), current_hour):
+            self.advanced_slot = None
             return False
         
         # Проверяем минимальный интервал между постами
@@ -240,9 +315,33 @@ class VillageBloggerAgent:
             time_diff = current_time - self.last_post_time
             if time_diff.total_seconds() < self.min_interval_hours * 3600:
                 return False
-        
-        # Случайный фактор (70% вероятность поста в подходящее время)
-        return random.random() < 0.7
+
+        # Вне расписания публикуем только внутри дня: после прошлого слота плюс минимальный интервал
+        # и до следующего, который досрочная публикация и занимает
+        if current_hour not in self.posting_hours:
+            earlier = [h for h in self.posting_hours if h < current_hour]
+            later = [h for h in self.posting_hours if h > current_hour]
+            if not earlier or not later:
+                return False
+            previous_slot = current_time.replace(hour=max(earlier), minute=0, second=0, microsecond=0)
+            if current_time - previous_slot < datetime.timedelta(hours=self.min_interval_hours):
+                return False
+
+        decision = self.controller.decide()
+        logger.info(f"Адаптивная частота: {decision.action} — {decision.reason}")
+
+        # Вне расписания — только если прошлый пост хорошо заходит
+        if current_hour not in self.posting_hours:
+            if decision.action != ADVANCE:
+                return False
+            self.advanced_slot = (current_time.date(), min(later))
+            logger.info(f"Слот {min(later)}:00 публикуется досрочно")
+            return True
+
+        if decision.action == DELAY:
+            self.delayed_until = current_time + datetime.timedelta(minutes=decision.delay_minutes)
+            return False
+        return decision.action != SKIP
     
     def select_topic(self) -> str:
         """Выбирает тему для поста на основе весов"""
@@ -252,8 +351,19 @@ class VillageBloggerAgent:
     
     def analyze_recent_performance(self) -> Dict:
         """Анализирует производительность недавних постов"""
-        posts = self.vk_poster.get_wall_posts(count=20)
-        
+        owner_id = self.vk_poster.owner_id
+
+        # Со стены дочитываем только новые посты, дальше переопрашиваем растущие
+        newest = self.metrics.newest_date(owner_id)
+        if newest is None:
+            self.metrics.track(self.vk_poster.get_wall_posts(count=20))
+        else:
+            self.metrics.track(fetch_new_posts(
+                lambda offset, count: self.vk_poster.get_wall_posts(count=count, offset=offset), newest
+            ))
+            self.metrics.refresh(self.vk_poster.get_posts_by_id)
+        posts = self.metrics.posts_since(owner_id, 0, limit=20)
+
         if not posts:
             return {}
         
@@ -272,13 +382,37 @@ class VillageBloggerAgent:
         logger.info(f"Средняя активность: {avg_engagement}")
         return avg_engagement
     
+    def generate_checked_post(self, topic: str) -> Optional[str]:
+        """
+        Генерирует пост и перегенерирует его с замечаниями проверки, только если она не пройдена.
+        Возвращает None, если ни один вариант нельзя публиковать.
+        """
+        history = self.metrics.posts_since(self.vk_poster.owner_id, 0, limit=50)
+        post_content = self.content_generator.generate_post(topic)
+        score = self.scorer.score(post_content, history)
+        attempts = 0
+        # Без модели перегенерация вернет тот же резервный пост
+        while not score.passed and self.content_generator.model and attempts < self.draft_retry_budget:
+            attempts += 1
+            logger.info(f"Пост отклонен проверкой ({score.feedback()}), попытка {attempts}")
+            candidate = self.content_generator.generate_post(topic, feedback=score.feedback())
+            candidate_score = self.scorer.score(candidate, history)
+            if (candidate_score.publishable, candidate_score.score) > (score.publishable, score.score):
+                post_content, score = candidate, candidate_score
+        if not score.publishable:
+            logger.error(f"Пост не прошел проверку, публикация пропущена: {score.feedback()}")
+            return None
+        return post_content
+
     def create_and_post(self) -> bool:
         """Создает и публикует новый пост"""
         try:
             topic = self.select_topic()
             logger.info(f"Выбрана тема: {topic}")
             
-            post_content = self.content_generator.generate_post(topic)
+            post_content = self.generate_checked_post(topic)
+            if not post_content:
+                return False
             logger.info(f"Контент сгенерирован, длина: {len(post_content)} символов")
             
             success = self.vk_poster.post_to_wall(post_content)
@@ -433,6 +567,7 @@ def test_agent():
 if __name__ == "__main__":
     # Установка зависимостей:
     # pip install requests schedule google-generativeai python-dotenv
+    configure_logging()
     
     print("🌾 ДЕРЕВЕНСКИЙ БЛОГГЕР АГЕНТ 🌾")
     print("=" * 50)
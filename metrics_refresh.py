@@ -0,0 +1,227 @@
+import os
+import json
+import time
+import sqlite3
+import logging
+from contextlib import contextmanager
+from datetime import timedelta
+from typing import Callable, Dict, Iterable, Iterator, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# ======================
+# --- Расписание повторного опроса ---
+# ======================
+
+# (возраст поста, интервал опроса): чем старше пост, тем реже опрашиваем
+GROWTH_SCHEDULE = [
+    (timedelta(hours=6), timedelta(minutes=30)),
+    (timedelta(hours=24), timedelta(hours=2)),
+    (timedelta(days=3), timedelta(hours=6)),
+    (timedelta(days=7), timedelta(hours=24)),
+]
+
+# wall.getById принимает до 100 идентификаторов за вызов
+GET_BY_ID_BATCH = 100
+
+
+def next_poll_delay(age: timedelta) -> Optional[timedelta]:
+    """Интервал до следующего опроса поста данного возраста или None, если рост закончился"""
+    for max_age, interval in GROWTH_SCHEDULE:
+        if age < max_age:
+            return interval
+    return None
+
+
+def _counts(post: dict) -> Dict[str, int]:
+    return {
+        "likes": post.get("likes", {}).get("count", 0),
+        "reposts": post.get("reposts", {}).get("count", 0),
+        "views": post.get("views", {}).get("count", 0),
+        "comments": post.get("comments", {}).get("count", 0),
+    }
+
+
+# ======================
+# --- Хранилище метрик ---
+# ======================
+
+class MetricsRefresher:
+    """
+    Хранит посты и временные ряды их метрик.
+    Повторно опрашивает только посты, которые еще набирают активность,
+    с увеличением интервала по мере старения поста.
+    """
+    def __init__(self, db_path: str = "data/metrics.db"):
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        with self._connect() as conn:
+            conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS posts (
+                    owner_id INTEGER NOT NULL,
+                    post_id INTEGER NOT NULL,
+                    date INTEGER NOT NULL,
+                    next_poll_at INTEGER,
+                    raw TEXT NOT NULL,
+                    PRIMARY KEY (owner_id, post_id)
+                );
+                CREATE TABLE IF NOT EXISTS snapshots (
+                    owner_id INTEGER NOT NULL,
+                    post_id INTEGER NOT NULL,
+                    ts INTEGER NOT NULL,
+                    likes INTEGER NOT NULL,
+                    reposts INTEGER NOT NULL,
+                    views INTEGER NOT NULL,
+                    comments INTEGER NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS idx_posts_poll ON posts (next_poll_at);
+                CREATE INDEX IF NOT EXISTS idx_snapshots_post ON snapshots (owner_id, post_id, ts);
+                """
+            )
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            yield conn
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _schedule(self, date: int, now: int) -> Optional[int]:
+        delay = next_poll_delay(timedelta(seconds=now - date))
+        return now + int(delay.total_seconds()) if delay else None
+
+    def newest_date(self, owner_id: int) -> Optional[int]:
+        """Дата самого свежего известного поста группы"""
+        with self._connect() as conn:
+            row = conn.execute("SELECT MAX(date) FROM posts WHERE owner_id = ?", (owner_id,)).fetchone()
+        return row[0]
+
+    def track(self, posts: Iterable[dict]):
+        """Добавляет или обновляет посты и записывает снимок их текущих метрик"""
+        now = int(time.time())
+        with self._connect() as conn:
+            for p in posts:
+                counts = _counts(p)
+                conn.execute(
+                    "INSERT INTO posts (owner_id, post_id, date, next_poll_at, raw) VALUES (?, ?, ?, ?, ?) "
+                    "ON CONFLICT (owner_id, post_id) DO UPDATE SET next_poll_at = excluded.next_poll_at, raw = excluded.raw",
+                    (p["owner_id"], p["id"], p["date"], self._schedule(p["date"], now), json.dumps(p, ensure_ascii=False)),
+                )
+                conn.execute(
+                    "INSERT INTO snapshots VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (p["owner_id"], p["id"], now, counts["likes"], counts["reposts"], counts["views"], counts["comments"]),
+                )
+
+    def due(self, now: Optional[int] = None) -> List[str]:
+        """Идентификаторы постов вида '<owner_id>_<post_id>', которые пора опросить"""
+        now = now or int(time.time())
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT owner_id, post_id FROM posts WHERE next_poll_at IS NOT NULL AND next_poll_at <= ?",
+                (now,),
+            ).fetchall()
+        return [f"{owner_id}_{post_id}" for owner_id, post_id in rows]
+
+    def refresh(self, fetch_by_id: Callable[[List[str]], List[dict]]) -> int:
+        """
+        Опрашивает посты в окне роста пачками через wall.getById.
+        fetch_by_id получает список идентификаторов и возвращает посты.
+        Возвращает количество обновленных постов.
+        """
+        ids = self.due()
+        updated = 0
+        for i in range(0, len(ids), GET_BY_ID_BATCH):
+            batch = ids[i:i + GET_BY_ID_BATCH]
+            try:
+                items = fetch_by_id(batch)
+            except Exception as e:
+                logger.error(f"Ошибка обновления метрик: {e}")
+                break
+            if isinstance(items, dict):
+                items = items.get("items", [])
+            self.track(items)
+            updated += len(items)
+            # Удаленные посты не возвращаются — перестаем их опрашивать
+            returned = {f"{p['owner_id']}_{p['id']}" for p in items}
+            missing = [pid for pid in batch if pid not in returned]
+            if missing:
+                self._stop_polling(missing)
+            if i + GET_BY_ID_BATCH < len(ids):
+                time.sleep(0.34)
+
+        if ids:
+            logger.info(f"Обновлены метрики {updated} из {len(ids)} постов ({(len(ids) - 1) // GET_BY_ID_BATCH + 1} запросов)")
+        return updated
+
+    def _stop_polling(self, ids: List[str]):
+        with self._connect() as conn:
+            for pid in ids:
+                owner_id, post_id = pid.rsplit("_", 1)
+                conn.execute(
+                    "UPDATE posts SET next_poll_at = NULL WHERE owner_id = ? AND post_id = ?",
+                    (int(owner_id), int(post_id)),
+                )
+
+    def posts_since(self, owner_id: int, since: int, limit: Optional[int] = None) -> List[dict]:
+        """Посты группы начиная с даты since (новые первыми) с последними известными метриками"""
+        query = "SELECT raw FROM posts WHERE owner_id = ? AND date >= ? ORDER BY date DESC"
+        params = [owner_id, since]
+        if limit:
+            query += " LIMIT ?"
+            params.append(limit)
+        with self._connect() as conn:
+            rows = conn.execute(query, params).fetchall()
+        return [json.loads(raw) for (raw,) in rows]
+
+    def iter_posts(self, owner_id: int, since: int, until: Optional[int] = None, chunk_size: int = 25) -> Iterator[List[dict]]:
+        """Потоково отдает посты группы за период (старые первыми) пачками по chunk_size"""
+        until = until or int(time.time())
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "SELECT raw FROM posts WHERE owner_id = ? AND date >= ? AND date < ? ORDER BY date",
+                (owner_id, since, until),
+            )
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield [json.loads(raw) for (raw,) in rows]
+
+    def curve(self, owner_id: int, post_id: int) -> List[Dict[str, int]]:
+        """Временной ряд метрик поста"""
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT ts, likes, reposts, views, comments FROM snapshots "
+                "WHERE owner_id = ? AND post_id = ? ORDER BY ts",
+                (owner_id, post_id),
+            ).fetchall()
+        return [
+            {"ts": ts, "likes": likes, "reposts": reposts, "views": views, "comments": comments}
+            for ts, likes, reposts, views, comments in rows
+        ]
+
+
+def fetch_new_posts(get_page: Callable[[int, int], List[dict]], since: int, count: int = 100) -> List[dict]:
+    """
+    Листает стену до первого уже известного (или слишком старого) поста.
+    get_page(offset, count) — страница wall.get (список постов).
+    Закрепленный пост может быть старым, поэтому он не останавливает обход.
+    """
+    posts = []
+    offset = 0
+    while True:
+        items = get_page(offset, count)
+        if not items:
+            break
+
+        posts.extend(item for item in items if item["date"] > since)
+
+        if any(item["date"] <= since and not item.get("is_pinned") for item in items):
+            break
+
+        offset += count
+        time.sleep(0.34)
+    return posts
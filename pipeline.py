@@ -0,0 +1,390 @@
+import os
+import asyncio
+import logging
+import time
+from collections import Counter
+from concurrent.futures import Executor
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from content_calendar import MOSCOW_TZ
+from draft_scorer import DraftScore
+from job_control import CycleDeadlineExceeded, Deadline
+from publish_journal import slot_key
+from rate_limit import call_deadline
+from workers import ProcessWorkers
+
+logger = logging.getLogger(__name__)
+
+FETCH = "fetch"
+AGGREGATE = "aggregate"
+RECOMMEND = "recommend"
+GENERATE = "generate"
+IMAGE = "image"
+SCORE = "score"
+PUBLISH = "publish"
+
+# Этап: (сколько вызовов одновременно на все группы, таймаут в секундах)
+STAGE_LIMITS = {
+    FETCH: (4, 120),
+    AGGREGATE: (4, 30),
+    RECOMMEND: (2, 120),
+    GENERATE: (2, 120),
+    IMAGE: (1, 180),
+    SCORE: (4, 10),
+    PUBLISH: (4, 120),
+}
+
+# Этапы, которые считают на CPU и уходят в пул процессов
+CPU_STAGES = {SCORE}
+
+
+@dataclass
+class StageResult:
+    stage: str
+    ok: bool
+    value: Any = None
+    error: Optional[str] = None
+    elapsed: float = 0.0
+
+
+@dataclass
+class SlotInput:
+    """Все, что нужно для генерации поста слота"""
+    topic: str
+    old_blog_posts: str
+    time_context: Optional[str] = None
+    with_image: bool = False
+    history: Optional[List[dict]] = None
+    plan_slot: Optional[dict] = None
+    # Картинка, нарисованная заранее (prefill)
+    image_path: Optional[str] = None
+
+
+@dataclass
+class CycleResult:
+    journal_key: str
+    stages: Dict[str, StageResult] = field(default_factory=dict)
+    published: bool = False
+
+
+class Stage:
+    """
+    Этап конвейера со своим лимитом конкурентности и таймаутом.
+    Блокирующие функции (VK, Gemini, sqlite) выполняются в потоках,
+    CPU-тяжелые — в executor пула процессов, если он задан;
+    event loop при этом свободен для других групп.
+    """
+    def __init__(self, name: str, concurrency: int, timeout: Optional[float], executor: Optional[Executor] = None):
+        self.name = name
+        self.timeout = timeout
+        self.executor = executor
+        self._semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(self, func: Callable, *args) -> StageResult:
+        async with self._semaphore:
+            started = time.monotonic()
+            # Срок этапа (и цикла, если он раньше) виден блокирующему коду в потоке через call_deadline
+            deadlines = [d for d in (call_deadline.get(), started + self.timeout if self.timeout else None) if d]
+            token = call_deadline.set(min(deadlines) if deadlines else None)
+            try:
+                if self.executor:
+                    call = asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+                else:
+                    call = asyncio.to_thread(func, *args)
+                value = await asyncio.wait_for(call, self.timeout)
+                return StageResult(self.name, True, value, elapsed=time.monotonic() - started)
+            except asyncio.TimeoutError:
+                error = f"таймаут {self.timeout} с"
+            except Exception as e:
+                error = str(e)
+            finally:
+                call_deadline.reset(token)
+            if self.executor:
+                # Пул процессов мог не успеть запуститься или упасть — считаем в текущем процессе
+                logger.warning(f"Этап {self.name}: пул процессов не справился ({error}), выполняю в основном процессе")
+                try:
+                    value = await asyncio.to_thread(func, *args)
+                    return StageResult(self.name, True, value, elapsed=time.monotonic() - started)
+                except Exception as e:
+                    error = str(e)
+            logger.error(f"Этап {self.name}: {error}")
+            return StageResult(self.name, False, error=error, elapsed=time.monotonic() - started)
+
+
+class PostingPipeline:
+    """
+    Цикл публикации как asyncio-конвейер типизированных этапов:
+    fetch → aggregate → recommend → generate (+ image параллельно) → score → publish.
+    Один экземпляр на event loop обслуживает циклы всех групп, лимиты этапов общие.
+    """
+    def __init__(
+        self,
+        limits: Dict[str, Tuple[int, float]] = STAGE_LIMITS,
+        draft_retry_budget: int = 2,
+        candidates: int = 1,
+        workers: Optional[ProcessWorkers] = None,
+    ):
+        executor = workers.executor if workers else None
+        self.stages = {
+            name: Stage(name, concurrency, timeout, executor if name in CPU_STAGES else None)
+            for name, (concurrency, timeout) in limits.items()
+        }
+        self.draft_retry_budget = draft_retry_budget
+        self.candidates = candidates
+
+    async def run_cycle(
+        self, blogger, tenant: str, slot_at: Optional[datetime] = None, deadline: Optional[Deadline] = None
+    ) -> CycleResult:
+        """Полный цикл слота; по истечении срока отменяет незавершенные этапы"""
+        deadline = deadline or Deadline()
+        result = CycleResult(journal_key=slot_key(tenant, slot_at))
+        remaining = deadline.remaining()
+        if remaining is not None and remaining <= 0:
+            raise CycleDeadlineExceeded(f"срок {deadline.at} истек до начала цикла")
+        # Задача цикла копирует контекст: срок цикла ограничивает и ожидание лимитов в этапах
+        token = call_deadline.set(time.monotonic() + remaining if remaining is not None else None)
+        try:
+            await asyncio.wait_for(self._cycle(blogger, tenant, slot_at, result), remaining)
+        except asyncio.TimeoutError:
+            raise CycleDeadlineExceeded(
+                f"срок {deadline.at} истек, выполнены этапы: {', '.join(result.stages) or 'нет'}"
+            )
+        finally:
+            call_deadline.reset(token)
+        for stage in result.stages.values():
+            logger.info(f"[{result.journal_key}] {stage.stage}: {'ok' if stage.ok else stage.error} за {stage.elapsed:.1f} с")
+        return result
+
+    async def _cycle(self, blogger, tenant: str, slot_at: Optional[datetime], result: CycleResult):
+        journal_key = result.journal_key
+        # Повтор или перезапуск в тот же слот берет черновик из журнала
+        draft = await asyncio.to_thread(blogger.journal.draft, journal_key)
+        if draft:
+            logger.info(f"[{journal_key}] Черновик слота уже сгенерирован, продолжаю публикацию")
+            # Картинку удаляет очередь доставки после отправки; недошедшие направления получат текст
+            image_path = draft["image_path"] if draft["image_path"] and os.path.exists(draft["image_path"]) else None
+            result.published = await self._publish(blogger, draft["text"], image_path, journal_key, result)
+            return
+
+        slot_input = await self._prepare(blogger, slot_at, result)
+        if not slot_input:
+            return
+
+        # Картинка рисуется параллельно с текстом, у каждого слота свой файл
+        image_task = None
+        image_path = slot_input.image_path if slot_input.image_path and os.path.exists(slot_input.image_path) else None
+        if slot_input.with_image and not image_path:
+            image_task = asyncio.create_task(self.stages[IMAGE].run(
+                blogger.generate_image_post,
+                slot_input.topic,
+                _image_path(journal_key),
+                slot_input.time_context,
+            ))
+
+        try:
+            text, score = await self._generate(blogger, tenant, slot_input, result)
+            if image_task:
+                image = await image_task
+                result.stages[IMAGE] = image
+                image_path = image.value[1] if image.ok else None
+                if not image_path:
+                    logger.warning("Картинка не получилась, публикую текстовый пост.")
+        finally:
+            # Цикл отменен по сроку — картинку больше не ждем
+            if image_task and not image_task.done():
+                image_task.cancel()
+
+        if not score or not score.publishable:
+            logger.error(f"Черновик не прошел проверку, слот пропущен: {score.feedback() if score else 'нет черновика'}")
+            await self._mark(blogger, slot_input.plan_slot, "skipped")
+            if image_path and os.path.exists(image_path):
+                os.remove(image_path)
+            return
+
+        await asyncio.to_thread(blogger.journal.save_draft, journal_key, text, image_path)
+        result.published = await self._publish(blogger, text, image_path, journal_key, result)
+        await self._mark(blogger, slot_input.plan_slot, "published" if result.published else "failed")
+
+    async def _prepare(self, blogger, slot_at: Optional[datetime], result: CycleResult) -> Optional[SlotInput]:
+        """Тема и контекст слота: из недельного плана или через аналитику"""
+        analytics = blogger.analytics_agent
+        plan, slot = await asyncio.to_thread(blogger.planner.slot_for, slot_at)
+        if slot:
+            logger.info(f"Слот из плана: {slot['topic']} ({slot['time_context']})")
+            history = await self.stages[FETCH].run(analytics.blog_history)
+            result.stages[FETCH] = history
+            # Сводка плана заморожена на момент планирования — берем посты, вышедшие за неделю
+            old_blog_posts = analytics.summarize_blog(history.value) if history.ok else plan["old_blog_posts"]
+            return SlotInput(
+                topic=slot["topic"],
+                old_blog_posts=old_blog_posts,
+                time_context=slot["time_context"],
+                with_image=slot["with_image"],
+                history=history.value if history.ok else None,
+                plan_slot=slot,
+                image_path=slot.get("image_path"),
+            )
+
+        fetch = await self.stages[FETCH].run(analytics.fetch_posts_last_week)
+        result.stages[FETCH] = fetch
+        if not fetch.ok:
+            return None
+        posts, blog_posts = fetch.value
+
+        aggregate = await self.stages[AGGREGATE].run(analytics.aggregate_posts, posts, blog_posts)
+        result.stages[AGGREGATE] = aggregate
+        if not aggregate.ok:
+            return None
+        combined_text, combined_blog = aggregate.value
+
+        recommend = await self.stages[RECOMMEND].run(analytics.recommend_topics, combined_text)
+        result.stages[RECOMMEND] = recommend
+        if not recommend.ok or not recommend.value:
+            logger.warning("Нет рекомендаций от аналитика, слот пропущен.")
+            return None
+        return SlotInput(topic=recommend.value, old_blog_posts=combined_blog, history=blog_posts)
+
+    async def _generate(
+        self, blogger, tenant: str, slot_input: SlotInput, result: CycleResult
+    ) -> Tuple[Optional[str], Optional[DraftScore]]:
+        """
+        Берет черновик из запаса или генерирует self.candidates вариантов и выбирает
+        лучший локально (объем, новизна, прогноз вовлеченности). Остальные годные
+        варианты уходят в запас для следующих слотов.
+        Перегенерирует, только если все варианты отклонены, не больше draft_retry_budget раз.
+        """
+        # Черновик из запаса должен быть написан под то же время суток и сезон;
+        # слот плана берет только черновик своей темы, чтобы план не разъезжался
+        time_context = slot_input.time_context or blogger._get_time_context()
+        pooled = await asyncio.to_thread(
+            blogger.drafts.take, tenant, time_context, slot_input.topic, slot_input.plan_slot is not None
+        )
+        if pooled:
+            scored = await self.stages[SCORE].run(blogger.scorer.score, pooled["text"], slot_input.history)
+            result.stages[SCORE] = scored
+            if scored.ok and scored.value.publishable:
+                logger.info(f"Черновик из запаса ({pooled['topic']}), генерация не нужна")
+                return pooled["text"], scored.value
+
+        candidates: List[Tuple[str, DraftScore]] = []
+        feedback = None
+        for attempt in range(self.draft_retry_budget + 1):
+            generated = await self.stages[GENERATE].run(
+                blogger.generate_posts, slot_input.topic, slot_input.old_blog_posts,
+                self.candidates, feedback, time_context,
+            )
+            result.stages[GENERATE] = generated
+            if not generated.ok or not generated.value:
+                # Сбой генерации — не повод перегенерировать: следующий запрос упадет так же
+                logger.warning(f"Генерация не удалась: {generated.error or 'модель не вернула текстов'}")
+                break
+            scored = await self.stages[SCORE].run(blogger.scorer.rank, generated.value, slot_input.history)
+            result.stages[SCORE] = scored
+            if not scored.ok:
+                break
+            candidates.extend(scored.value)
+            best_score = scored.value[0][1]
+            if best_score.passed:
+                break
+            feedback = best_score.feedback()
+            logger.info(f"Варианты попытки {attempt + 1} отклонены скорером: {feedback}")
+
+        if not candidates:
+            return None, None
+        candidates.sort(key=lambda item: (item[1].publishable, item[1].rank), reverse=True)
+        best, best_score = candidates[0]
+        await asyncio.to_thread(self._stash, blogger, tenant, slot_input.topic, time_context, best, candidates[1:])
+        return best, best_score
+
+    def _stash(
+        self, blogger, tenant: str, topic: str, time_context: str,
+        winner: Optional[str], rest: List[Tuple[str, DraftScore]],
+    ) -> int:
+        """Годные и непохожие друг на друга варианты — в запас черновиков"""
+        kept = [winner] if winner else []
+        added = 0
+        for text, score in rest:
+            if not score.passed or any(blogger.scorer.similar(text, other) for other in kept):
+                continue
+            blogger.drafts.add(tenant, topic, time_context, text, score.rank)
+            kept.append(text)
+            added += 1
+        if added:
+            logger.info(f"В запас черновиков добавлено вариантов: {added}")
+        return added
+
+    async def prefill(self, blogger, tenant: str):
+        """
+        Готовит слоты плана заранее, пока черновик не устареет (DraftPool.max_age):
+        тексты под тему и контекст времени слота — в запас черновиков,
+        картинки слотов «с картинкой» — в файл слота. В момент слота остается
+        проверить готовое и опубликовать, Gemini не вызывается.
+        """
+        now = datetime.now(MOSCOW_TZ)
+        slots = await asyncio.to_thread(
+            blogger.planner.upcoming, now, now + timedelta(seconds=blogger.drafts.max_age)
+        )
+        if not slots:
+            return
+        history = await self.stages[FETCH].run(blogger.analytics_agent.blog_history)
+        if not history.ok:
+            logger.warning(f"[{tenant}] Заготовка слотов пропущена: нет истории блога ({history.error})")
+            return
+        old_blog_posts = blogger.analytics_agent.summarize_blog(history.value)
+
+        needed: Counter = Counter()
+        for slot in slots:
+            at = datetime.fromisoformat(slot["at"])
+            topic, time_context = slot["topic"], slot["time_context"]
+            # Несколько слотов с одной темой и одним контекстом берут из одного запаса
+            needed[topic, time_context] += 1
+            ready = await asyncio.to_thread(blogger.drafts.available, tenant, time_context, topic)
+            if ready < needed[topic, time_context]:
+                generated = await self.stages[GENERATE].run(
+                    blogger.generate_posts, topic, old_blog_posts, self.candidates, None, time_context,
+                )
+                if not generated.ok or not generated.value:
+                    logger.warning(f"[{tenant}] Не удалось заготовить текст слота {at}, сгенерирую в момент слота")
+                    # Сбой генерации (429, квота) — остальные слоты тоже подождут
+                    return
+                scored = await self.stages[SCORE].run(blogger.scorer.rank, generated.value, history.value)
+                if scored.ok:
+                    await asyncio.to_thread(self._stash, blogger, tenant, topic, time_context, None, scored.value)
+
+            if slot["with_image"] and not (slot.get("image_path") and os.path.exists(slot["image_path"])):
+                image = await self.stages[IMAGE].run(
+                    blogger.generate_image_post, topic, _image_path(slot_key(tenant, at)), time_context,
+                )
+                if image.ok and image.value[1]:
+                    await asyncio.to_thread(blogger.planner.attach_image, at, image.value[1])
+        logger.info(f"[{tenant}] Заготовлено слотов плана: {len(slots)}")
+
+    async def _publish(
+        self, blogger, text: str, image_path: Optional[str], journal_key: str, result: CycleResult
+    ) -> bool:
+        """Публикация в VK и Telegram одновременно"""
+        if image_path:
+            calls = [(blogger.post_image_to_vk, text, image_path, journal_key),
+                     (blogger.post_image_to_telegram, text, image_path, journal_key)]
+        else:
+            calls = [(blogger.post_to_vk, text, journal_key),
+                     (blogger.post_to_telegram, text, journal_key)]
+        published = await asyncio.gather(*(self.stages[PUBLISH].run(*call) for call in calls))
+        result.stages[PUBLISH] = StageResult(
+            PUBLISH,
+            all(p.ok for p in published),
+            error="; ".join(p.error for p in published if p.error) or None,
+            elapsed=max(p.elapsed for p in published),
+        )
+        return result.stages[PUBLISH].ok
+
+    async def _mark(self, blogger, plan_slot: Optional[dict], status: str):
+        if plan_slot:
+            await asyncio.to_thread(blogger.planner.mark, datetime.fromisoformat(plan_slot["at"]), status)
+
+
+def _image_path(journal_key: str) -> str:
+    """Файл картинки слота"""
+    return f"data/post_image_{journal_key.replace(':', '_')}.png"
@@ -0,0 +1,133 @@
+import os
+import json
+import time
+import sqlite3
+import logging
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Состояния шага публикации в одно направление (VK, Telegram)
+QUEUED = "queued"
+SENDING = "sending"
+PUBLISHED = "published"
+FAILED = "failed"
+
+
+def slot_key(tenant: str, at: Optional[datetime] = None) -> str:
+    """
+    Ключ идемпотентности публикации: группа + час слота расписания.
+    Повтор или перезапуск задачи в тот же слот получает тот же ключ.
+    """
+    at = at or datetime.now()
+    return f"{tenant}:{at.strftime('%Y-%m-%dT%H')}"
+
+
+class PublishJournal:
+    """
+    Журнал публикаций с упреждающей записью.
+    Хранит сгенерированный черновик слота и состояние каждого шага по каждому
+    направлению, чтобы повтор продолжил с упавшего шага, а не публиковал заново.
+    """
+    def __init__(self, db_path: str = "data/publish_journal.db"):
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        with self._connect() as conn:
+            conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS drafts (
+                    key TEXT PRIMARY KEY,
+                    text TEXT NOT NULL,
+                    image_path TEXT,
+                    created_at INTEGER NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS steps (
+                    key TEXT NOT NULL,
+                    destination TEXT NOT NULL,
+                    state TEXT NOT NULL,
+                    data TEXT NOT NULL,
+                    updated_at INTEGER NOT NULL,
+                    PRIMARY KEY (key, destination)
+                );
+                """
+            )
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            yield conn
+            conn.commit()
+        finally:
+            conn.close()
+
+    def draft(self, key: str) -> Optional[dict]:
+        """Ранее сгенерированный черновик слота"""
+        with self._connect() as conn:
+            row = conn.execute("SELECT text, image_path FROM drafts WHERE key = ?", (key,)).fetchone()
+        if not row:
+            return None
+        return {"text": row[0], "image_path": row[1]}
+
+    def save_draft(self, key: str, text: str, image_path: Optional[str] = None):
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO drafts VALUES (?, ?, ?, ?)",
+                (key, text, image_path, int(time.time())),
+            )
+
+    def step(self, key: str, destination: str) -> Tuple[Optional[str], dict]:
+        """Текущее состояние и накопленные данные шага (None, {}) если шага не было"""
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT state, data FROM steps WHERE key = ? AND destination = ?",
+                (key, destination),
+            ).fetchone()
+        if not row:
+            return None, {}
+        return row[0], json.loads(row[1])
+
+    def record(self, key: str, destination: str, state: str, **data):
+        """Записывает состояние шага, дополняя ранее сохраненные данные"""
+        _, old_data = self.step(key, destination)
+        old_data.update(data)
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO steps VALUES (?, ?, ?, ?, ?)",
+                (key, destination, state, json.dumps(old_data, ensure_ascii=False), int(time.time())),
+            )
+
+    def mark_queued(self, key: str, destination: str):
+        """
+        Отмечает шаг поставленным в очередь доставки. Вызывается после постановки задания,
+        поэтому уже записанный очередью результат (published) не перезаписывается.
+        """
+        with self._connect() as conn:
+            conn.execute(
+                """
+                INSERT INTO steps VALUES (?, ?, ?, '{}', ?)
+                ON CONFLICT (key, destination) DO UPDATE
+                SET state = excluded.state, updated_at = excluded.updated_at
+                WHERE steps.state = ?
+                """,
+                (key, destination, QUEUED, int(time.time()), FAILED),
+            )
+
+    def finished(self, key: str, destination: str) -> bool:
+        """
+        True, если отправлять повторно не нужно: пост уже опубликован, ждет
+        в очереди доставки или прошлая отправка оборвалась в неизвестном состоянии.
+        """
+        state, _ = self.step(key, destination)
+        if state == PUBLISHED:
+            logger.info(f"[{key}] {destination}: уже опубликовано, пропускаю")
+            return True
+        if state == QUEUED:
+            logger.info(f"[{key}] {destination}: уже в очереди доставки, пропускаю")
+            return True
+        if state == SENDING:
+            logger.warning(f"[{key}] {destination}: прошлая отправка прервана, результат неизвестен — не повторяю")
+            return True
+        return False
@@ -0,0 +1,79 @@
+import time
+import threading
+from contextvars import ContextVar
+from typing import Optional
+
+# Срок (по time.monotonic), после которого результат вызова уже никому не нужен:
+# этап конвейера отменен по таймауту. asyncio.to_thread переносит значение в поток этапа,
+# и ожидание токенов прекращается вместе с этапом, не тратя квоту на брошенный запрос.
+call_deadline: ContextVar[Optional[float]] = ContextVar("call_deadline", default=None)
+
+
+class RateLimitTimeout(Exception):
+    """Срок этапа истек раньше, чем освободились токены; запрос не отправлялся"""
+
+
+class TokenBucket:
+    """
+    Потокобезопасный токен-бакет: rate токенов в секунду, запас до capacity.
+    Используется для квот Gemini и лимитов площадок.
+    """
+    def __init__(self, rate: float, capacity: float = 1):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def wait_time(self, tokens: float = 1) -> float:
+        """Сколько секунд ждать, пока наберется нужное число токенов"""
+        with self._lock:
+            self._refill()
+            return max(0.0, (tokens - self._tokens) / self.rate)
+
+    def try_acquire(self, tokens: float = 1) -> bool:
+        deadline = call_deadline.get()
+        if deadline is not None and time.monotonic() >= deadline:
+            return False
+        with self._lock:
+            self._refill()
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return True
+            return False
+
+    def acquire(self, tokens: float = 1, timeout: Optional[float] = None) -> bool:
+        """
+        Блокирует до получения токенов. Возвращает False по истечении timeout;
+        если раньше истекает срок этапа (call_deadline) — RateLimitTimeout.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        stage_deadline = call_deadline.get()
+        while True:
+            if stage_deadline is not None and time.monotonic() >= stage_deadline:
+                raise RateLimitTimeout("срок этапа истек в ожидании лимита, запрос не отправлен")
+            with self._lock:
+                self._refill()
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return True
+                wait = (tokens - self._tokens) / self.rate
+            if deadline is not None:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    return False
+                wait = min(wait, left)
+            if stage_deadline is not None:
+                wait = min(wait, max(stage_deadline - time.monotonic(), 0))
+            time.sleep(wait)
+
+    def penalize(self, seconds: float):
+        """Откладывает выдачу токенов: площадка попросила подождать (429 / retry_after)"""
+        with self._lock:
+            self._refill()
+            self._tokens = min(self._tokens, 0) - seconds * self.rate
@@ -0,0 +1,140 @@
+import os
+import re
+import json
+import time
+import logging
+import threading
+from dataclasses import asdict, dataclass
+from typing import Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+CLUB_RE = re.compile(r"^(?:club|public|event)(\d+)$")
+
+
+def normalize_group_ref(group) -> str:
+    """
+    Приводит ссылку на группу к виду для groups.getById:
+    '-123', '123', 'club123' -> '123'; короткое имя остается как есть.
+    """
+    ref = str(group).strip().lstrip("-")
+    match = CLUB_RE.match(ref)
+    return match.group(1) if match else ref
+
+
+@dataclass
+class GroupInfo:
+    id: int
+    screen_name: str
+    name: str
+    members_count: int
+    fetched_at: float
+
+    @property
+    def owner_id(self) -> int:
+        """owner_id для wall.*: у сообществ всегда со знаком минус"""
+        return -self.id
+
+
+class GroupResolver:
+    """
+    Кеш метаданных групп VK (id, название, число подписчиков) с TTL.
+    Хранится на диске между запусками и общий для всех компонентов,
+    так что groups.getById уходит из горячего пути цикла.
+    Если VK недоступен, отдается устаревшая запись.
+    fetch(refs) — groups.getById(group_ids=",".join(refs), fields="members_count").
+    """
+    def __init__(
+        self,
+        fetch: Callable[[List[str]], List[dict]],
+        cache_path: str = "data/vk_groups.json",
+        ttl_hours: float = 24,
+    ):
+        self.fetch = fetch
+        self.cache_path = cache_path
+        self.ttl = ttl_hours * 3600
+        self._lock = threading.Lock()
+        self._cache: Dict[str, GroupInfo] = self._load()
+
+    def _load(self) -> Dict[str, GroupInfo]:
+        if not os.path.exists(self.cache_path):
+            return {}
+        try:
+            with open(self.cache_path, encoding="utf-8") as f:
+                return {ref: GroupInfo(**info) for ref, info in json.load(f).items()}
+        except (ValueError, TypeError) as e:
+            logger.warning(f"Кеш групп VK поврежден, начинаю заново: {e}")
+            return {}
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.cache_path) or ".", exist_ok=True)
+        tmp_path = f"{self.cache_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({ref: asdict(info) for ref, info in self._cache.items()}, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.cache_path)
+
+    def _fresh(self, info: Optional[GroupInfo]) -> bool:
+        return info is not None and time.time() - info.fetched_at < self.ttl
+
+    def resolve_many(self, groups: List) -> List[GroupInfo]:
+        """Метаданные нескольких групп в порядке запроса; устаревшие записи обновляются одним groups.getById"""
+        refs = [normalize_group_ref(g) for g in groups]
+        with self._lock:
+            missing = [ref for ref in dict.fromkeys(refs) if not self._fresh(self._cache.get(ref))]
+            if missing:
+                try:
+                    items = self.fetch(missing)
+                    if isinstance(items, dict):
+                        items = items.get("groups", items.get("items", []))
+                except Exception as e:
+                    # Числовой id известен и без VK, метаданные подтянутся при следующем обращении
+                    for ref in missing:
+                        if ref not in self._cache and ref.isdigit():
+                            self._cache[ref] = GroupInfo(int(ref), ref, "", 0, fetched_at=0)
+                    if any(ref not in self._cache for ref in missing):
+                        raise
+                    logger.warning(f"groups.getById недоступен, беру устаревшие данные групп {missing}: {e}")
+                    items = []
+
+                # VK может пропустить несуществующую группу или склеить две ссылки на одну,
+                # поэтому ответ сопоставляется с запросом по id и короткому имени, а не по порядку
+                by_ref = {}
+                for item in items:
+                    by_ref[str(item["id"])] = item
+                    if item.get("screen_name"):
+                        by_ref[item["screen_name"].lower()] = item
+
+                now = time.time()
+                for ref in missing:
+                    item = by_ref.get(ref.lower())
+                    if not item:
+                        if items:
+                            logger.warning(f"groups.getById не вернул группу «{ref}»")
+                        continue
+                    info = GroupInfo(
+                        id=item["id"],
+                        screen_name=item.get("screen_name", ref),
+                        name=item.get("name", ""),
+                        members_count=item.get("members_count", 0),
+                        fetched_at=now,
+                    )
+                    # Группа доступна и по короткому имени, и по числовому id
+                    self._cache[ref] = info
+                    self._cache[str(info.id)] = info
+                if items:
+                    self._save()
+
+            unknown = [ref for ref in refs if ref not in self._cache]
+            if unknown:
+                raise LookupError(f"группы VK не найдены: {', '.join(unknown)}")
+            return [self._cache[ref] for ref in refs]
+
+    def resolve(self, group) -> GroupInfo:
+        return self.resolve_many([group])[0]
+
+    def owner_id(self, group) -> int:
+        return self.resolve(group).owner_id
+
+    def group_id(self, group) -> int:
+        """Положительный id группы (для photos.*, groups.*)"""
+        return self.resolve(group).id
@@ -0,0 +1,185 @@
+import os
+import time
+import sqlite3
+import hashlib
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Iterable, Iterator, List, Optional
+
+from metrics_refresh import MetricsRefresher
+from rate_limit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+CHUNK_PROMPT = (
+    "Ты аналитик, который кратко подводит итоги по группе ВКонтакте с учетом лайков, репостов и просмотров.\n"
+    "Перечисли главные новости и события из этих постов, отметь самые популярные:\n"
+)
+REDUCE_PROMPT = (
+    "Объедини эти частичные сводки новостей в одну, без повторов, сохранив самые популярные события:\n"
+)
+FINAL_PROMPT = (
+    "Составь итоговый выпуск новостей за неделю по этим сводкам. "
+    "Сгруппируй по темам, самые популярные события — в начале:\n"
+)
+
+
+def format_post(p: dict) -> str:
+    text = p["text"].replace("\n", " ").strip()
+    date = datetime.fromtimestamp(p["date"]).strftime('%Y-%m-%d %H:%M')
+    likes = p.get("likes", {}).get("count", 0)
+    reposts = p.get("reposts", {}).get("count", 0)
+    views = p.get("views", {}).get("count", 0)
+    return f"{date} | {text}\n| Лайки: {likes} | Репосты: {reposts} | Просмотры: {views}"
+
+
+def hash_text(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:16]
+
+
+class WeeklyDigest:
+    """
+    Недельный дайджест как потоковый map-reduce по архиву постов:
+    посты читаются из хранилища пачками, пачки суммаризуются параллельно
+    под общим лимитом запросов к Gemini, сводки кешируются и сворачиваются
+    в итоговый выпуск. Повторный запуск по тем же постам почти бесплатен.
+    """
+    def __init__(
+        self,
+        model,
+        limiter: TokenBucket,
+        metrics: MetricsRefresher,
+        cache_path: str = "data/digest_cache.db",
+        chunk_size: int = 25,
+        max_workers: int = 4,
+        reduce_fanout: int = 8,
+        max_retries: int = 3,
+        retry_delay: float = 20,
+    ):
+        self.model = model
+        self.limiter = limiter
+        self.metrics = metrics
+        self.cache_path = cache_path
+        self.chunk_size = chunk_size
+        self.max_workers = max_workers
+        self.reduce_fanout = reduce_fanout
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        os.makedirs(os.path.dirname(cache_path) or ".", exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS summaries (key TEXT PRIMARY KEY, summary TEXT NOT NULL)")
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.cache_path, timeout=30)
+        try:
+            yield conn
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _summarize(self, instruction: str, text: str, cache_key: Optional[str] = None) -> str:
+        """Суммаризация с кешем по хешу входа (или по переданному ключу)"""
+        key = hashlib.sha256(f"{instruction}\n{cache_key or text}".encode("utf-8")).hexdigest()
+        with self._connect() as conn:
+            row = conn.execute("SELECT summary FROM summaries WHERE key = ?", (key,)).fetchone()
+        if row:
+            return row[0]
+
+        for attempt in range(self.max_retries + 1):
+            self.limiter.acquire()
+            try:
+                summary = self.model.generate_content(instruction + text).text.strip()
+                break
+            except Exception as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = self.retry_delay * 2 ** attempt
+                # 429 и сбои квоты: притормаживаем и остальные запросы через общий лимит
+                self.limiter.penalize(delay)
+                logger.warning(f"Ошибка суммаризации, повтор через {delay:.0f} с: {e}")
+        with self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO summaries VALUES (?, ?)", (key, summary))
+        return summary
+
+    def _day_chunks(self, owner_id: int, since: int, until: Optional[int]) -> Iterator[List[dict]]:
+        """
+        Пачки постов, выровненные по дням: при сдвиге недельного окна
+        границы пачек не меняются и их сводки берутся из кеша.
+        """
+        chunk, day = [], None
+        for batch in self.metrics.iter_posts(owner_id, since, until, self.chunk_size):
+            for p in batch:
+                post_day = datetime.fromtimestamp(p["date"]).date()
+                if chunk and (post_day != day or len(chunk) >= self.chunk_size):
+                    yield chunk
+                    chunk = []
+                chunk.append(p)
+                day = post_day
+        if chunk:
+            yield chunk
+
+    def _map(self, chunks: Iterable[List[dict]]) -> Iterator[str]:
+        """
+        Суммаризует пачки параллельно, держа в работе не больше max_workers * 2 пачек,
+        чтобы память не зависела от объема архива. Порядок пачек сохраняется.
+        Пачка, не давшаяся и после повторов, пропускается — дайджест собирается из остальных.
+        """
+        def result(future) -> Optional[str]:
+            try:
+                return future.result()
+            except Exception as e:
+                logger.error(f"Пачка постов не суммаризована, пропускаю ее в дайджесте: {e}")
+                return None
+
+        window = self.max_workers * 2
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            pending = []
+            for chunk in chunks:
+                chunk = [p for p in chunk if p.get("text")]
+                if not chunk:
+                    continue
+                text = "\n\n".join(format_post(p) for p in chunk)
+                # Метрики постов растут постоянно, поэтому ключ кеша — сами посты, а не их счетчики
+                cache_key = "|".join(f"{p['owner_id']}_{p['id']}:{hash_text(p['text'])}" for p in chunk)
+                pending.append(pool.submit(self._summarize, CHUNK_PROMPT, text, cache_key))
+                if len(pending) >= window:
+                    summary = result(pending.pop(0))
+                    if summary:
+                        yield summary
+            for future in pending:
+                summary = result(future)
+                if summary:
+                    yield summary
+
+    def _reduce(self, summaries: List[str]) -> List[str]:
+        """Сворачивает сводки группами по reduce_fanout, пока не останется одна группа"""
+        while len(summaries) > self.reduce_fanout:
+            groups = [summaries[i:i + self.reduce_fanout] for i in range(0, len(summaries), self.reduce_fanout)]
+            with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+                summaries = list(pool.map(lambda g: self._summarize(REDUCE_PROMPT, "\n\n".join(g)), groups))
+        return summaries
+
+    def build(self, owner_id: int, since: int, until: Optional[int] = None) -> str:
+        """Дайджест постов группы за период [since, until)"""
+        started = time.time()
+        summaries = list(self._map(self._day_chunks(owner_id, since, until)))
+        if not summaries:
+            return ""
+        summaries = self._reduce(summaries)
+        digest = self._summarize(FINAL_PROMPT, "\n\n".join(summaries))
+        logger.info(f"Дайджест группы {owner_id} собран за {time.time() - started:.1f} с")
+        return digest
+
+    def write(self, owner_id: int, since: int, path: str, title: str) -> Optional[str]:
+        """Собирает дайджест и сохраняет его в файл с заголовком выпуска"""
+        digest = self.build(owner_id, since)
+        if not digest:
+            logger.warning(f"Нет постов для дайджеста группы {owner_id}")
+            return None
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(f"{title}\n{digest}")
+        return path
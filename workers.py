@@ -0,0 +1,80 @@
+import logging
+from concurrent.futures import Executor, Future, ProcessPoolExecutor
+from io import BytesIO
+from multiprocessing import get_context, shared_memory
+from typing import Callable, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+def _save_image_from_shm(shm_name: str, size: int, save_path: str) -> Tuple[int, int]:
+    """Декодирует изображение из общей памяти и сохраняет его (выполняется в процессе-воркере)"""
+    from PIL import Image
+
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        view = shm.buf[:size]
+        try:
+            with Image.open(BytesIO(view)) as image:
+                image.save(save_path)
+                return image.size
+        finally:
+            view.release()
+    finally:
+        shm.close()
+
+
+def _save_image(data: bytes, save_path: str) -> Tuple[int, int]:
+    from PIL import Image
+
+    with Image.open(BytesIO(data)) as image:
+        image.save(save_path)
+        return image.size
+
+
+class ProcessWorkers:
+    """
+    Пул процессов для CPU-тяжелой работы (PIL, скоринг, аналитика),
+    чтобы она не отнимала GIL у шедулера и сетевых потоков.
+    Байты изображений передаются через общую память, а не сериализацией в очередь пула.
+    max_workers = 0 — все выполняется в текущем процессе, как раньше.
+    """
+    def __init__(self, max_workers: int = 0):
+        self.max_workers = max_workers
+        # spawn: форк процесса с живыми потоками шедулера небезопасен
+        self.pool = ProcessPoolExecutor(max_workers, mp_context=get_context("spawn")) if max_workers else None
+        if self.pool:
+            logger.info(f"Пул воркеров запущен: {max_workers} процессов")
+
+    @property
+    def executor(self) -> Optional[Executor]:
+        """Executor для loop.run_in_executor; None — пул потоков по умолчанию"""
+        return self.pool
+
+    def submit(self, func: Callable, *args) -> Future:
+        """Запускает func(*args) в пуле; func и аргументы должны сериализоваться pickle"""
+        if self.pool:
+            return self.pool.submit(func, *args)
+        future = Future()
+        try:
+            future.set_result(func(*args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def save_image(self, data: bytes, save_path: str) -> Tuple[int, int]:
+        """Декодирует и сохраняет изображение в воркере. Возвращает его размер"""
+        if not self.pool:
+            return _save_image(data, save_path)
+
+        shm = shared_memory.SharedMemory(create=True, size=len(data))
+        try:
+            shm.buf[:len(data)] = data
+            return self.pool.submit(_save_image_from_shm, shm.name, len(data), save_path).result()
+        finally:
+            shm.close()
+            shm.unlink()
+
+    def shutdown(self):
+        if self.pool:
+            self.pool.shutdown(wait=True, cancel_futures=True)